@@ -21,7 +21,6 @@
 
 import discord
 import asyncpg
-import markovify
 from discord.ext import commands
 
 import os
@@ -31,14 +30,24 @@ import psutil
 import logging
 import asyncio
 import aiohttp
+import argparse
 import datetime
 from random import sample
-from importlib import reload
+from time import perf_counter
+from importlib import reload, import_module
 from traceback import print_exc
 from collections import Counter
 
 import cogs
 from cogs.utils.checks import ChannelError
+from cogs.utils.db import Database, CONNECTION
+from cogs.utils.ipc import IPCClient, IPC_PORT, IPC_TOKEN_ENV
+from cogs.utils.metrics import Metrics, EventCounter
+from cogs.utils.stats import PopulationStats
+from cogs.utils.cache import TTLCache
+from cogs.utils.http import FetchClient
+from cogs.utils.logs import setup_logging, LEVELS
+from cogs.utils.markov import MarkovEngine, MarkovSettings, DEFAULT_VOICE
 from WebServer import CmdRunner
 
 try:
@@ -53,22 +62,39 @@ if os.getcwd().endswith("pytest"):
     sys.argv.append("debug")
 
 
-class Typheus(commands.Bot):
-    def __init__(self, sh_channel=None, **kwargs):
+# Cogs loaded on startup, each is the class of the same name in cogs/<name>.py
+COGS = ("Admin", "Misc", "ChannelUtils", "RPG", "NSFW")
+
+
+class Typheus(commands.AutoShardedBot):
+    def __init__(self, sh_channel=None, cluster=None, clusters=1, **kwargs):
+        self.command_version = 0  # Bumped whenever a command is added or removed, Bot.__init__ already adds one
         super().__init__(**kwargs)
+        self.remove_command("help")  # Misc has its own, removed here once since on_ready runs on every READY
         self.owner_id = 122739797646245899
         self.lounge_id = 166349353999532035
         self.uptime = datetime.datetime.utcnow()
         self.commands_used = Counter()
         self.server_commands = Counter()
-        self.socket_stats = Counter()
+        self.events = EventCounter()
+        self.socket_stats = self.events.total
+        self.shard_events = Counter()
+        self.metrics = Metrics()
+        self.metrics.register("typheus_gateway_events_total", "counter", "Gateway events received, by type",
+                              lambda: {(("event", event),): count for event, count in self.events.total.items()})
+        self.metrics.register("typheus_shard_events_total", "counter", "Guild scoped gateway events received, by shard",
+                              lambda: {(("shard", shard),): count for shard, count in self.shard_events.items()})
+        self.metrics.register("typheus_shard_latency_seconds", "gauge", "Heartbeat latency of each shard",
+                              lambda: {(("shard", shard),): latency for shard, latency in self.latencies})
+        self.population = PopulationStats(self)
         self.debug = "debug" in sys.argv
         self.shutdowns = []
-        self.cogs = None
         self.running = True
         self.webserv = None
         self.cmd = None
+        self.ipc = None
         self.conn = None
+        self.db = None
         self._shutdown_channel = sh_channel
         self.startup_quips = [
                               "PSI Connect β",
@@ -90,31 +116,37 @@ class Typheus(commands.Bot):
                               "Turning Japanese"
                               ]
 
-        with open("resources/dave.txt", "rb") as tsf:
-            self._model_base = tsf.read().decode("utf-8", 'replace')
-        self._markov_model = markovify.NewlineText(self._model_base)
-
-        self.logger = logging.getLogger('discord')  # Discord Logging
-        self.logger.setLevel(logging.DEBUG)
-        self.handler = logging.FileHandler(filename=os.path.join('resources', 'discord.log'), encoding='utf-8', mode='w')
-        self.handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-        self.logger.addHandler(self.handler)
-        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.markov = MarkovEngine(loop=self.loop)
+        self.markov_settings = MarkovSettings()
+        self._markov_pending = set()
+
+        levels = dict(LEVELS, discord=logging.DEBUG) if self.debug else LEVELS
+        # Discord and command logging, written off the event loop. Each cluster has its own file,
+        # rotating one file from several processes loses lines
+        self.cluster = cluster
+        self.clusters = clusters
+        log = 'discord.log' if cluster is None else 'discord.{}.log'.format(cluster)
+        setup_logging(path=os.path.join('resources', log), levels=levels)
+        self.logger = logging.getLogger('typheus.commands')
+        self.session = aiohttp.ClientSession(loop=self.loop,
+                                             connector=aiohttp.TCPConnector(limit_per_host=8, loop=self.loop))
+        self.fetcher = FetchClient(self.session, loop=self.loop)
+        self.metrics.register("typheus_http_cache_total", "counter", "Cached GETs to external APIs, by outcome",
+                              lambda: {(("result", result),): count for result, count in self.fetcher.stats().items()
+                                       if result != "size"})
+        self._app_info = TTLCache(maxsize=1, ttl=3600)
         self.shutdowns.append(self.shutdown)
 
     async def on_ready(self):
-        self.remove_command("help")
-        self.conn = await asyncpg.create_pool(user='root', password='root',
-                                               database='typheus', host='127.0.0.1')
+        if self.conn is None:  # on_ready runs again after a reconnect, keep the pool the cogs are using
+            self.conn = await asyncpg.create_pool(**CONNECTION)
+            self.db = Database(self.conn, metrics=self.metrics)
 
-        self.cogs = {"Admin": cogs.Admin.Admin(self),
-                     "Misc": cogs.Misc.Misc(self),
-                     "ChannelUtils": cogs.ChannelUtils.ChannelUtils(self),
-                     "RPG": cogs.RPG.RPG(self),
-                     "NSFW": cogs.NSFW.NSFW(self)}
-
-        for cog in self.cogs.values():
-            self.add_cog(cog)
+        for name in COGS:
+            if name not in self.cogs:  # on_ready runs again after a reconnect, the cogs are still loaded
+                await self.setup_cog(self.load_cog(name))
+        if self.markov_settings.db is None:  # After RPG.setup, which creates the tables
+            await self.markov_settings.load(self.db)
 
         # Login info
         print('Logged in as')
@@ -131,6 +163,8 @@ class Typheus(commands.Bot):
                 pass
 
         await self.change_presence(game=discord.Game(name=";help for help!"))
+        if self.ipc is not None:
+            self.ipc.notify("ready", cluster=self.ipc.cluster)
         if self._shutdown_channel:
             channel = discord.utils.get(self.get_all_channels(), id=self._shutdown_channel)
             with channel.typing():
@@ -142,11 +176,13 @@ class Typheus(commands.Bot):
 
     async def update_stats(self):
         url = "https://bots.discord.pw/api/bots/{}/stats".format(self.user.id)
-        payload = json.dumps(dict(server_count=len(self.guilds))).encode()
         headers = {'authorization': self.cmd._auth[1], "Content-Type": "application/json"}
-
-        async with self.session.post(url, data=payload, headers=headers) as response:
-            await response.read()
+        guilds = Counter(guild.shard_id for guild in self.guilds)
+        for shard_id in self.shard_ids or range(self.shard_count):
+            payload = json.dumps(dict(shard_id=shard_id, shard_count=self.shard_count,
+                                      server_count=guilds[shard_id])).encode()
+            async with self.session.post(url, data=payload, headers=headers) as response:
+                await response.read()
 
         self.loop.call_later(14400, lambda: asyncio.ensure_future(self.update_stats()))
 
@@ -163,9 +199,19 @@ class Typheus(commands.Bot):
                     await self.markov_mention(message)
                 except discord.errors.Forbidden:
                     pass
+        elif self.markov_settings.is_learning(message.channel.id) and not message.content.startswith(self.command_prefix):
+            self.markov.learn(message.guild.id, message.clean_content)
 
         await self.process_commands(message)
 
+    async def invoke(self, ctx):
+        # Timed here rather than in on_command/on_command_completion, which run as their own tasks,
+        # so converters and checks are counted and scheduling delay isn't. Failures are timed too
+        start = perf_counter()
+        await super().invoke(ctx)
+        if ctx.command is not None:
+            self.metrics.observe_command(ctx.command.qualified_name, perf_counter() - start)
+
     async def on_command(self, ctx):
         self.commands_used[ctx.command] += 1
         if isinstance(ctx.author, discord.Member):
@@ -184,13 +230,16 @@ class Typheus(commands.Bot):
         else:
             destination = '#{0.channel.name} ({0.guild.name})'.format(ctx.message)
 
-        self.logger.info('{0.created_at}: {0.author.name} in {1}: {0.content}'.format(ctx.message, destination))
+        self.logger.info('%s: %s in %s: %s', ctx.message.created_at, ctx.message.author.name, destination, ctx.message.content)
 
     async def on_command_error(self, error, ctx):
         """
         Universal handling for discord errors, will print unknown errors,
         and silently pass Forbidden errors.
         """
+        if ctx.command is not None:
+            self.metrics.command_error(ctx.command.qualified_name, error)
+
         if isinstance(error, ChannelError):
             await ctx.send("```py\n{}\n```".format(error.__message__))
         elif isinstance(error, commands.NoPrivateMessage):
@@ -208,12 +257,69 @@ class Typheus(commands.Bot):
         elif isinstance(error, commands.CheckFailure):
             await ctx.send("You do not have permission to use this command or it is disabled here!")
 
-    async def on_socket_response(self, msg):
-        self.socket_stats[msg.get('t')] += 1
+    def add_command(self, command):
+        super().add_command(command)
+        self.command_version += 1
+
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        self.command_version += 1
+        return command
+
+    def load_cog(self, name):
+        """Create and add the cog `name` from its module cogs.<name>"""
+        module = sys.modules.get("cogs." + name) or import_module("cogs." + name)
+        cog = getattr(module, name)(self)
+        self.add_cog(cog)
+        return cog
+
+    async def setup_cog(self, cog):
+        if hasattr(cog, "setup"):
+            await cog.setup()
+
+    async def reload_cog(self, name):
+        """Re-import cogs.<name> and swap the running cog for one built from the new code.
+        The connection, caches, database pool and HTTP session are all left alone.
+        If importing or building the new cog fails, the old one stays loaded"""
+        names = {cog.lower(): cog for cog in COGS}
+        if name.lower() not in names:
+            raise ValueError("No cog called {}".format(name))
+        name = names[name.lower()]
+        module = reload(sys.modules["cogs." + name]) if "cogs." + name in sys.modules else import_module("cogs." + name)
+        new = getattr(module, name)(self)
+
+        old = self.get_cog(name)
+        if old is not None:
+            self.remove_cog(name)
+            self.shutdowns = [shutdown for shutdown in self.shutdowns if getattr(shutdown, "__self__", None) is not old]
+        self.add_cog(new)
+        await self.setup_cog(new)
+        return new
+
+    async def get_app_info(self):
+        """application_info(), only asking the API once an hour"""
+        info = self._app_info.get("info")
+        if info is None:
+            info = self._app_info["info"] = await self.application_info()
+        return info
+
+    def dispatch(self, event, *args, **kwargs):
+        # Count every gateway frame inline, rather than scheduling an on_socket_response task per frame
+        if event == 'socket_response':
+            msg = args[0]
+            self.events.record(msg.get('t'))
+            guild_id = guild_of(msg)
+            if guild_id is not None:
+                self.shard_events[(guild_id >> 22) % (self.shard_count or 1)] += 1
+            if not self.extra_events.get('on_socket_response'):
+                return
+        super().dispatch(event, *args, **kwargs)
 
     async def on_member_join(self, member):
         try:
-            RPG = self.cogs["RPG"]
+            RPG = self.get_cog("RPG")
+            if RPG is None:
+                return
             amount = (await RPG.get_settings(member.guild))["start"]
             if amount:
                 await RPG.add_eco(member, amount)
@@ -221,8 +327,18 @@ class Typheus(commands.Bot):
             return
 
     async def markov_mention(self, message):
-        response = self._markov_model.make_sentence(tries=100)
-        await message.channel.send(response)
+        if message.channel.id in self._markov_pending:
+            return  # Already answering a mention here, one reply covers the lot
+        self._markov_pending.add(message.channel.id)
+        try:
+            voice = DEFAULT_VOICE
+            if message.guild is not None:
+                voice = self.markov_settings.voice(message.guild.id)
+            response = await self.markov.sentence(voice, guild_id=message.guild.id if message.guild else None)
+            if response:
+                await message.channel.send(response)
+        finally:
+            self._markov_pending.discard(message.channel.id)
 
     async def get_bot_uptime(self):
         """Get time between now and when the bot went up"""
@@ -245,8 +361,64 @@ class Typheus(commands.Bot):
         return mu / 1_000_000
 
     async def shutdown(self):
+        # Unload every cog first, so their __unload hooks stop the lottery scheduler and the
+        # catalog refreshers instead of leaving them running on the loop the next Typheus shares
+        for name in list(self.cogs):
+            self.remove_cog(name)
+        await self.markov.flush()
         self.session.close()
 
+
+def guild_of(msg):
+    """The id of the guild a gateway payload is about, if it's about one"""
+    data = msg.get('d')
+    if not isinstance(data, dict):
+        return None
+    if msg.get('t') in ("GUILD_CREATE", "GUILD_UPDATE", "GUILD_DELETE"):
+        guild_id = data.get('id')
+    else:
+        guild_id = data.get('guild_id')
+    return int(guild_id) if guild_id is not None else None
+
+
+def shard_options(argv):
+    """Shard settings from the command line, '--shards 0-3' (or '0,2,5') and '--shard-count 8'.
+    Without them every shard runs in this process, as many as Discord recommends"""
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--shards")
+    parser.add_argument("--shard-count", type=int)
+    args, _ = parser.parse_known_args(argv)
+    options = dict()
+    if args.shard_count is not None:
+        options["shard_count"] = args.shard_count
+    if args.shards:
+        shard_ids = []
+        for part in args.shards.split(","):
+            first, _, last = part.partition("-")
+            shard_ids.extend(range(int(first), int(last or first) + 1))
+        options["shard_ids"] = shard_ids
+    return options
+
+
+def cluster_options(argv):
+    """'--cluster 2' marks this process as one of the launcher's '--clusters' workers, '--ipc-port' is where to find it"""
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--cluster", type=int)
+    parser.add_argument("--clusters", type=int, default=1)
+    parser.add_argument("--ipc-port", type=int, default=IPC_PORT)
+    args, _ = parser.parse_known_args(argv)
+    return args.cluster, args.clusters, args.ipc_port
+
+
+def reload_cog_modules():
+    """reload(cogs) only re-runs the package's __init__, reload every cog module instead.
+    cogs.utils is left alone, its modules hold state (the log listener) and classes
+    (ChannelError) that the bot bound at import time"""
+    for name in COGS:
+        if "cogs." + name in sys.modules:
+            reload(sys.modules["cogs." + name])
+
+
 async def runserv(typheus):
     typheus.cmd = CmdRunner(typheus)
     typheus.webserv = typheus.cmd.app
@@ -259,6 +431,8 @@ def main():
 
     loop = asyncio.get_event_loop()
     prefix = ';' if 'debug' not in sys.argv else '$'
+    shards = shard_options(sys.argv[1:])
+    cluster, clusters, ipc_port = cluster_options(sys.argv[1:])
     invlink = "https://discordapp.com/oauth2/authorize?client_id=284456340879966231&scope=bot&permissions=322641"
     servinv = "https://discord.gg/UYJb8fQ"
     description = """Typheus, a little discord bot by Henry#6174\n**Add to your server**: {}\n**Support Server**: {}
@@ -270,9 +444,17 @@ def main():
             loop=loop,
             description=description,
             command_prefix=prefix,
-            pm_help=True)
-
-        asyncio.ensure_future(runserv(typheus))
+            pm_help=True,
+            cluster=cluster,
+            clusters=clusters,
+            **shards)
+
+        if cluster is None:
+            asyncio.ensure_future(runserv(typheus))
+        else:  # The launcher runs the web server, this worker only answers it over IPC
+            typheus.cmd = CmdRunner(typheus)
+            typheus.ipc = IPCClient(typheus, cluster, os.environ.get(IPC_TOKEN_ENV), port=ipc_port, loop=loop)
+            typheus.ipc.start()
         await typheus.start(*auth)
         for shutdown in typheus.shutdowns:
             await shutdown()
@@ -283,16 +465,25 @@ def main():
                 sh_channel = typheus._shutdown_channel
             cmd = typheus.cmd
             webserv = typheus.webserv
+            markov = typheus.markov
+            ipc = typheus.ipc
             typheus = Typheus(
                               loop=loop,
                               description=description,
                               command_prefix=prefix,
                               pm_help=True,
-                              sh_channel=sh_channel)
+                              sh_channel=sh_channel,
+                              cluster=cluster,
+                              clusters=clusters,
+                              **shards)
             cmd.bot = typheus
             typheus.cmd = cmd
             typheus.webserv = webserv
-            reload(cogs)
+            typheus.markov = markov
+            typheus.ipc = ipc
+            if ipc is not None:
+                ipc.bot = typheus
+            reload_cog_modules()
             await typheus.start(*auth)
             for shutdown in typheus.shutdowns:
                 await shutdown()
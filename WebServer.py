@@ -36,6 +36,9 @@ from kyoukai import Kyoukai
 from kyoukai.asphalt import HTTPRequestContext, Response
 from werkzeug.exceptions import HTTPException
 
+from cogs.utils.db import Database
+from cogs.utils.metrics import merge
+
 
 class CmdRunner(object):
     app = Kyoukai("Typheus")
@@ -62,6 +65,10 @@ class CmdRunner(object):
             except KeyError:
                 raise HTTPException("Missing key or command", Response(status=400))
 
+        @self.app.route("/metrics", methods=["GET"])
+        async def metrics(ctx: HTTPRequestContext):
+            return Response(await self.get_metrics(), status=200, content_type="text/plain; version=0.0.4")
+
         @self.app.route("/servers/<int:snowflake>/", methods=["GET"])
         async def getservinfo(ctx: HTTPRequestContext, snowflake: int):
             try:
@@ -76,6 +83,13 @@ class CmdRunner(object):
             except:
                 return HTTPException("Invalid snowflake!", Response("Failed to fetch info!", status=400))
 
+    @property
+    def db(self):
+        return self.bot.db
+
+    async def get_metrics(self):
+        return self.bot.metrics.render()
+
     def cleanup_code(self, content):
         """Automatically removes code blocks from the code. Borrowed from RoboDanny"""
         # remove ```py\n```
@@ -128,21 +142,50 @@ class CmdRunner(object):
                 return '\n%s%s\n' % (value, ret)
 
     async def get_userdata(self, snowflake):
-        request = """SELECT info FROM userdata WHERE UUID = {}""".format(snowflake)
-        values = await self.bot.conn.fetch(request)
+        info = await self.db.get_full_inv(snowflake)
         try:
-            data = dict(snowflake=snowflake, info=json.loads(values[0]["info"]))
+            if not info:
+                raise KeyError(snowflake)
+            data = dict(snowflake=snowflake, info=info)
             return json.dumps(data, indent=4)
         except:
             print_exc()
             return json.dumps(dict(error="User not found!"))
 
     async def get_servdata(self, snowflake):
-        request = """SELECT info FROM servdata WHERE UUID = {}""".format(snowflake)
-        values = await self.bot.conn.fetch(request)
+        value = await self.db.fetchval("get_settings", snowflake)
         try:
-            data = dict(snowflake=snowflake, info=json.loads(values[0]["info"]))
+            data = dict(snowflake=snowflake, info=json.loads(value))
             return json.dumps(data, indent=4)
         except:
             print_exc()
             return json.dumps(dict(error="Server not found!"))
+
+
+class ClusterRunner(CmdRunner):
+    """The web server for a whole cluster, run once by the launcher. Commands and metrics
+    are fanned out to every worker over IPC, user and server lookups go to its own database pool"""
+    def __init__(self, launcher, pool):
+        super().__init__(None)
+        self.launcher = launcher
+        self._db = Database(pool, metrics=launcher.metrics)
+
+        @self.app.route("/restart", methods=["GET"])
+        async def restart(ctx: HTTPRequestContext):
+            if ctx.request.args.get('key') != self._key:
+                raise HTTPException("Incorrect key", Response(status=403))
+            asyncio.ensure_future(self.launcher.rolling_restart())
+            return Response("Rolling restart started", status=200)
+
+    @property
+    def db(self):
+        return self._db
+
+    async def get_metrics(self):
+        results = await self.launcher.broadcast("metrics")
+        return merge([self.launcher.metrics.render()] + [text for text in results.values() if isinstance(text, str)])
+
+    async def run_cmd(self, msg):
+        results = await self.launcher.broadcast("eval", body=msg)
+        return "".join("\n[Cluster {}]{}".format(cluster, result or "\n")
+                       for cluster, result in sorted(results.items()))
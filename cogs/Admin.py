@@ -31,6 +31,8 @@ from cogs.utils import checks
 from inspect import isawaitable
 from discord.ext import commands
 from traceback import format_exc
+from collections import Counter
+from time import perf_counter
 from contextlib import redirect_stdout
 
 
@@ -103,6 +105,33 @@ class Admin(object):
                 self._last_result = ret
                 await ctx.send('```py\n%s%s\n```' % (value, ret))
 
+    @commands.command(hidden=True)
+    @checks.is_owner()
+    async def perf(self, ctx, count: int=15):
+        """Show the slowest commands and queries by 95th percentile latency"""
+        metrics = self.bot.metrics
+        fmt = "{:<24} {:>7} {:>9} {:>9} {:>6}"
+        lines = [fmt.format("Command", "Calls", "p50 ms", "p95 ms", "Errors")]
+        errors = Counter()
+        for (name, error), total in metrics.command_errors.items():
+            errors[name] += total
+        timings = sorted(metrics.commands.items(), key=lambda x: x[1].quantile(0.95), reverse=True)
+        for name, histogram in timings[:count]:
+            lines.append(fmt.format(name[:24], histogram.count, "{:.1f}".format(histogram.quantile(0.5) * 1000),
+                                    "{:.1f}".format(histogram.quantile(0.95) * 1000), errors[name]))
+
+        lines.append("")
+        lines.append(fmt.format("Query", "Calls", "p50 ms", "p95 ms", "Errors"))
+        errors = Counter()
+        for (name, error), total in metrics.query_errors.items():
+            errors[name] += total
+        timings = sorted(metrics.queries.items(), key=lambda x: x[1].quantile(0.95), reverse=True)
+        for name, histogram in timings[:count]:
+            lines.append(fmt.format(name[:24], histogram.count, "{:.1f}".format(histogram.quantile(0.5) * 1000),
+                                    "{:.1f}".format(histogram.quantile(0.95) * 1000), errors[name]))
+
+        await ctx.send("```\n{}\n```".format("\n".join(lines)[:1990]))
+
     @commands.command(hidden=True)
     @checks.is_owner()
     async def repeatcommand(self, ctx, times: int, *, command):
@@ -127,6 +156,21 @@ class Admin(object):
             await shutdown()
         await self.bot.logout()
 
+    @commands.command(hidden=True)
+    @checks.is_owner()
+    async def reload(self, ctx, name: str):
+        """Reload one cog's code in place, without reconnecting"""
+        start = perf_counter()
+        try:
+            await self.bot.reload_cog(name)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        except Exception:
+            await ctx.send("```py\n{}\n```".format(format_exc()))
+            return
+        await ctx.send("Reloaded {} in {:.1f}ms".format(name, (perf_counter() - start) * 1000))
+
     @commands.command(hidden=True)
     @checks.is_owner()
     async def restart(self, ctx):
@@ -20,21 +20,27 @@
 # DEALINGS IN THE SOFTWARE.
 import io
 import os
-import ujson as json
 import psutil
 import base64
 import discord
 import asyncio
 import datetime
-import async_timeout
 from time import time
 from random import choice
 from textwrap import indent
 from cogs.utils import checks
-from collections import Counter
+from cogs.utils.markov import DEFAULT_VOICE, LEARNED_VOICE
+from cogs.utils.catalog import CatalogPool
+from cogs.utils.rendercache import RenderCache
 from discord.ext import commands
 from binascii import Error as PaddingError
-from bs4 import BeautifulSoup
+
+# Seconds between catalog refreshes, and how long a board goes unused before its refresher stops
+CATALOG_REFRESH = 120
+CATALOG_IDLE = 1800
+# Where rendered undertext boxes are kept, and how much disk they may take up
+UNDERTEXT_CACHE = os.path.join('resources', 'undertext')
+UNDERTEXT_CACHE_BYTES = 256_000_000
 
 
 class Misc(object):
@@ -42,6 +48,17 @@ class Misc(object):
         self.bot = bot
         self.emote = "\U0001F35F"
         self.session = self.bot.session
+        self._help = None
+        self._help_version = None
+        self.catalogs = CatalogPool(self.bot.fetcher, loop=self.bot.loop,
+                                    interval=CATALOG_REFRESH, idle=CATALOG_IDLE)
+        # Each cluster keeps its own cache, and its share of the disk budget
+        cache_dir = UNDERTEXT_CACHE if self.bot.cluster is None else os.path.join(UNDERTEXT_CACHE, str(self.bot.cluster))
+        self.renders = RenderCache(cache_dir, max_bytes=UNDERTEXT_CACHE_BYTES // self.bot.clusters, loop=self.bot.loop)
+        self.bot.loop.create_task(self.renders.load())
+
+    def __unload(self):
+        self.catalogs.stop()
 
     @commands.command()
     async def ping(self, ctx):
@@ -58,24 +75,23 @@ class Misc(object):
     async def info(self, ctx):
         """Bot Info"""
         me = self.bot.user if not ctx.guild else ctx.guild.me
-        appinfo = await self.bot.application_info()
+        appinfo = await self.bot.get_app_info()
         embed = discord.Embed()
         embed.set_author(name=me.display_name, icon_url=appinfo.owner.avatar_url)
         embed.add_field(name="Author", value='Henry#6174 (Discord ID: 122739797646245899)')
         embed.add_field(name="Library", value='discord.py (Python)')
         embed.add_field(name="Uptime", value=await self.bot.get_bot_uptime())
         embed.add_field(name="Servers", value="{} servers".format(len(self.bot.guilds)))
+        latencies = self.bot.latencies
+        embed.add_field(name="Shards", value="{} shards, {:.0f}ms average latency".format(
+            len(latencies), sum(latency for _, latency in latencies) * 1000 / max(len(latencies), 1)))
         embed.add_field(name="Commands Run", value='{} commands'.format(sum(self.bot.commands_used.values())))
 
-        total_members = sum(len(s.members) for s in self.bot.guilds)
-        total_online = sum(1 for m in self.bot.get_all_members() if m.status != discord.Status.offline)
-        unique_members = set(map(lambda x: x.id, self.bot.get_all_members()))
-        channel_types = Counter(isinstance(c, discord.TextChannel) for c in self.bot.get_all_channels())
-        voice = channel_types[False]
-        text = channel_types[True]
-        embed.add_field(name="Total Members", value='{} ({} online)'.format(total_members, total_online))
-        embed.add_field(name="Unique Members", value='{}'.format(len(unique_members)))
-        embed.add_field(name="Channels", value='{} text channels, {} voice channels'.format(text, voice))
+        population = self.bot.population
+        embed.add_field(name="Total Members", value='{} ({} online)'.format(population.members, population.online))
+        embed.add_field(name="Unique Members", value='{}'.format(population.unique))
+        embed.add_field(name="Channels", value='{} text channels, {} voice channels'.format(population.text_channels,
+                                                                                         population.voice_channels))
 
         embed.add_field(name="CPU Percentage", value="{}%".format(psutil.Process(os.getpid()).cpu_percent()))
         embed.add_field(name="Memory Usage", value="{0:.2f} MB".format(await self.bot.get_ram()))
@@ -109,7 +125,7 @@ class Misc(object):
             member = ctx.author
 
         roles = map(lambda x: x.name, member.roles)
-        shared = sum(1 for m in self.bot.get_all_members() if m.id == member.id)
+        shared = len(self.bot.population.shared_guilds(member.id))
         voice = member.voice
         if voice is not None:
             voice = voice.channel
@@ -182,14 +198,23 @@ class Misc(object):
         """Create an Undertale style text box
         https://github.com/valrus/undertale-dialog-generator
         Example Usage: ;undertext sprites/Papyrus/1.png "Sans!!!\""""
+        digest = self.renders.key(sprite, text)
+        cached = self.renders.get(digest)
+        if cached is not None:
+            with cached:
+                await ctx.send(file=discord.File(cached, filename=text + ".png"))
+            return
+
         try:
             async with ctx.channel.typing():
-                sprite = "undertale/static/images/" + sprite
                 response, data = await self.fetch('http://ianmccowan.nfshost.com/undertale/submit',
                                                   params={'text': text,
-                                                          'moodImg': sprite})
-                fp = io.BytesIO(base64.b64decode(data))
-                await ctx.send(file=discord.File(fp, filename=text + ".png"))
+                                                          'moodImg': "undertale/static/images/" + sprite},
+                                                  ttl=0)
+                image = base64.b64decode(data)
+                if image.startswith(b"\x89PNG"):  # Don't keep whatever the API sends back on failure
+                    await self.renders.put(digest, image)
+                await ctx.send(file=discord.File(io.BytesIO(image), filename=text + ".png"))
 
         except PaddingError:
             await ctx.send("API failure! Error Code: {} (You probably got the image path wrong)".format(response.status))
@@ -199,53 +224,64 @@ class Misc(object):
         """Check bot's uptime"""
         await ctx.send("```{}```".format(await self.bot.get_bot_uptime()))
 
-    async def fetch(self, *args, **kwargs):
-        with async_timeout.timeout(10):
-            async with self.session.get(*args, **kwargs) as response:
-                return response, await response.text()
+    async def fetch(self, url, **kwargs):
+        response = await self.bot.fetcher.get(url, **kwargs)
+        return response, response.text()
 
     @commands.command()
     async def pol(self, ctx):
         """Do you like /pol?"""
         with ctx.channel.typing():
-            for x in range(5):
-                try:
-                    response, data = await self.fetch('https://a.4cdn.org/pol/catalog.json')
-                    api = json.loads(data)
-                    html = choice(api[0]["threads"])["com"]
-                    snd = BeautifulSoup(html, 'html.parser').get_text()
-                    break
-                except (IndexError, KeyError):
-                    pass
-            else:
-                snd = "Failed to get a post!"
-            await ctx.send(snd, delete_after=300)
-            try:
-                ctx.message.delete()
-            except:
-                pass
+            snd = await self.catalogs.get("pol") or "Failed to get a post!"
+        await ctx.send(snd, delete_after=300)
+        try:
+            ctx.message.delete()
+        except:
+            pass
 
     @commands.command()
     @checks.nsfw_channel()
     async def fchan(self, ctx, board: str):
         """4 cham"""
         with ctx.channel.typing():
-            for x in range(5):
-                try:
-                    response, data = await self.fetch('https://a.4cdn.org/{}/catalog.json'.format(board))
-                    api = json.loads(data)
-                    html = choice(api[0]["threads"])["com"]
-                    snd = BeautifulSoup(html, 'html.parser').get_text()
-                    break
-                except (IndexError, KeyError):
-                    pass
-            else:
-                snd = "Failed to get a post!"
-            await ctx.send(snd, delete_after=300)
-            try:
-                ctx.message.delete()
-            except:
-                pass
+            snd = await self.catalogs.get(board.strip("/").lower()) or "Failed to get a post!"
+        await ctx.send(snd, delete_after=300)
+        try:
+            ctx.message.delete()
+        except:
+            pass
+
+    @commands.group(invoke_without_command=True)
+    async def markov(self, ctx):
+        """See which voice the bot uses when mentioned here, and which voices there are"""
+        current = self.bot.markov_settings.voice(ctx.guild.id) if ctx.guild else DEFAULT_VOICE
+        voices = list(self.bot.markov.voices) + [LEARNED_VOICE]
+        await ctx.send("Current voice: **{}**\nAvailable voices: {}".format(current, ", ".join(voices)))
+
+    @checks.mod_or_permissions()
+    @markov.command()
+    @checks.no_pm()
+    async def voice(self, ctx, name: str):
+        """Change which voice the bot answers mentions with in this server
+        Requires "Bot Mod" role"""
+        if name not in self.bot.markov.voices and name != LEARNED_VOICE:
+            await ctx.send("That is not a valid voice! See ;markov")
+            return
+        await self.bot.markov_settings.set_voice(ctx.guild.id, name)
+        await ctx.send("Voice changed to {}".format(name))
+
+    @checks.mod_or_permissions()
+    @markov.command()
+    @checks.no_pm()
+    async def learn(self, ctx):
+        """Toggle whether messages in this channel are learned from for the `learned` voice
+        Requires "Bot Mod" role"""
+        if self.bot.markov_settings.is_learning(ctx.channel.id):
+            await self.bot.markov_settings.set_learning(ctx.channel.id, ctx.guild.id, False)
+            await ctx.send("No longer learning from this channel")
+        else:
+            await self.bot.markov_settings.set_learning(ctx.channel.id, ctx.guild.id, True)
+            await ctx.send("Now learning from this channel! Use `;markov voice learned` to hear what I've picked up")
 
     @commands.command(aliases=["seduce", "seduceme"])
     async def sm(self, ctx):
@@ -273,9 +309,14 @@ class Misc(object):
         minutes = delta.total_seconds() / 60
         total = sum(self.bot.socket_stats.values())
         cpm = total / minutes
+        recent = self.bot.events.recent(5)
+        rpm = sum(recent.values()) / min(5, max(minutes, 1))
+
+        shards = "\n".join("Shard {}: {:.0f}ms, {} guild events".format(shard, latency * 1000, self.bot.shard_events[shard])
+                           for shard, latency in self.bot.latencies)
 
-        fmt = '%s socket events observed (%.2f/minute):\n%s'
-        await ctx.send(fmt % (total, cpm, self.bot.socket_stats))
+        fmt = '%s socket events observed (%.2f/minute, %.2f/minute over the last 5 minutes):\n%s\nLast 5 minutes:\n%s\n%s'
+        await ctx.send(fmt % (total, cpm, rpm, self.bot.socket_stats, recent, shards))
 
     @commands.command()
     async def help(self, ctx, *command):
@@ -314,18 +355,11 @@ class Misc(object):
             await ctx.send(value)
             return
 
-        desc = """
-Typheus, a little discord bot by Henry#6174
-**Add to your server:** https://discordapp.com/oauth2/authorize?client_id=284456340879966231&scope=bot&permissions=305196074
-**Join the Support Server:** https://discord.gg/UYJb8fQ
-;help {{command}} for more info on a command
-React with the given reactions to see info a set of commands.
-{}
-""".format("\n".join("{}: {}".format(n, c.emote) for n, c in self.bot.cogs.items() if c.emote))
-        embed = discord.Embed(description=desc)
+        description, pages = self.help_pages()
+        embed = discord.Embed(description=description)
         embed.set_author(name=ctx.author.name, icon_url=ctx.author.avatar_url)
         embed.set_thumbnail(url=self.bot.user.avatar_url)
-        embed.set_footer(text="Made by Henry#6174 using discord.py", icon_url=(await self.bot.application_info()).owner.avatar_url)
+        embed.set_footer(text="Made by Henry#6174 using discord.py", icon_url=(await self.bot.get_app_info()).owner.avatar_url)
         message = await ctx.author.send(embed=embed)
 
         emotes = {cog.emote: name for name, cog in self.bot.cogs.items() if cog.emote}
@@ -357,22 +391,44 @@ React with the given reactions to see info a set of commands.
                 return
 
             embed.clear_fields()
-            fmt = "**{}**: {}"
-            for command in self.bot.get_cog_commands(emotes[r.emoji]):
-                defhelp = command.help
-                if command.qualified_name == "help":
-                    continue
-                if isinstance(command, commands.Group):
-                    value = "{}\n__Subcommands:__\n\t{}".format(defhelp,
-                            "\n\t".join(fmt.format(x.qualified_name[len(command.qualified_name) + 1:], x.help) for x in command.commands))
+            for name, value in self.help_pages()[1].get(emotes[r.emoji], ()):
+                embed.add_field(name=name, value=value)
 
-                    if len(value) >= 1024:
-                        value = "{}\n__Subcommands:__\n\t{}".format(defhelp,
-                                                                  "\n\t".join(x.qualified_name[len(command.qualified_name) + 1:] for x in
-                                                                            command.commands))
-                else:
-                    value = defhelp
+            await message.edit(embed=embed)
 
-                embed.add_field(name=command.qualified_name, value=value)
+    def help_pages(self):
+        """The help menu's description and each cog's fields, only rebuilt when the bot's commands change"""
+        if self._help_version != self.bot.command_version:
+            description = """
+Typheus, a little discord bot by Henry#6174
+**Add to your server:** https://discordapp.com/oauth2/authorize?client_id=284456340879966231&scope=bot&permissions=305196074
+**Join the Support Server:** https://discord.gg/UYJb8fQ
+;help {{command}} for more info on a command
+React with the given reactions to see info a set of commands.
+{}
+""".format("\n".join("{}: {}".format(n, c.emote) for n, c in self.bot.cogs.items() if c.emote))
+            pages = {name: self.cog_help_fields(name) for name, cog in self.bot.cogs.items() if cog.emote}
+            self._help = (description, pages)
+            self._help_version = self.bot.command_version
+        return self._help
+
+    def cog_help_fields(self, name):
+        fields = []
+        fmt = "**{}**: {}"
+        for command in self.bot.get_cog_commands(name):
+            defhelp = command.help
+            if command.qualified_name == "help":
+                continue
+            if isinstance(command, commands.Group):
+                value = "{}\n__Subcommands:__\n\t{}".format(defhelp,
+                        "\n\t".join(fmt.format(x.qualified_name[len(command.qualified_name) + 1:], x.help) for x in command.commands))
+
+                if len(value) >= 1024:
+                    value = "{}\n__Subcommands:__\n\t{}".format(defhelp,
+                                                              "\n\t".join(x.qualified_name[len(command.qualified_name) + 1:] for x in
+                                                                        command.commands))
+            else:
+                value = defhelp
 
-            await message.edit(embed=embed)
\ No newline at end of file
+            fields.append((command.qualified_name, value))
+        return fields
\ No newline at end of file
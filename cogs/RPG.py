@@ -19,23 +19,34 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 from .utils import checks, dataIO
+from .utils.db import SCHEMA
+from .utils.cache import TTLCache
+from .utils.scheduler import DeadlineScheduler
+from .utils.sampling import AliasTable
 from discord.ext import commands
 from traceback import print_exc
 from collections import Counter
 from functools import wraps
 from random import choice, randint
 from copy import copy
+from time import perf_counter
+import datetime
 import discord
 import asyncio
+import asyncpg
 import ujson as json
 
+BULK_CHUNK = 5000
+MAX_LOOTBOXES = 1000  # Most boxes that can be opened by one ;lootbox buy
+SETTINGS_CACHE_SIZE = 2048
+SETTINGS_CACHE_TTL = 600  # Seconds, only matters if servdata is edited outside of update_settings
+
 
 def server_complex_mode(func):
     @wraps(func)
     async def predicate(self, ctx, *args, **kwargs):
-        settings = await self.get_settings(ctx.guild)
-        instgs = await self.in_settings(ctx.guild)
-        if not instgs or settings["mode"] == 0:
+        settings = await self.ctx_settings(ctx)
+        if settings["mode"] == 0:
             await ctx.send("This command requires complex mode to be enabled!"
                            " Use the `;settings configure` command to switch"
                            " to complex mode, where items are restricted to admin defined")
@@ -48,10 +59,8 @@ def server_complex_mode(func):
 def server_eco_mode(func):
     @wraps(func)
     async def predicate(self, ctx, *args, **kwargs):
-        settings = await self.get_settings(ctx.guild)
-        instgs = await self.in_settings(ctx.guild)
-        if not instgs or \
-           settings["mode"] == 0 or \
+        settings = await self.ctx_settings(ctx)
+        if settings["mode"] == 0 or \
            settings["eco"] == False:
 
             await ctx.send("To use this command the guild must be in complex mode and have economy enabled!"
@@ -78,37 +87,41 @@ class RPG(object):
 
         self.awaiting = dict()
         self.conn = self.bot.conn
-        self.lotteries = dict()
+        self.db = self.bot.db
+        self.lottery_scheduler = DeadlineScheduler(self.finish_lottery, loop=self.bot.loop)
+        self.settings_cache = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL)
+        self.bot.metrics.register("typheus_settings_cache_total", "counter", "Guild settings cache lookups",
+                                  lambda: {(("result", "hit"),): self.settings_cache.hits,
+                                           (("result", "miss"),): self.settings_cache.misses})
         self.defaultsettings = dict(mode=0, items=dict(), eco=False, cur="dollars", lootboxes=dict(), start=0)
-        self.defaultdump = json.dumps(self.defaultsettings).replace("'", "''")
+        self.defaultdump = json.dumps(self.defaultsettings)
 
     async def addserv(self, guild, mode=1, items=None, ecc=False, nil=False):
         if nil: # If there absolutely is not
-            req = """INSERT INTO servdata (UUID, info) VALUES ({0.id}, '{1}')""".format(guild, self.defaultdump)
-            async with self.conn.acquire() as connection:
-                await connection.fetchval(req)
+            await self.db.execute("add_settings", guild.id, self.defaultdump)
         else:
-            req = f"""SELECT info FROM servdata WHERE UUID = {guild.id}"""
-            async with self.conn.acquire() as connection:
-                values = await connection.fetchval(req)
-            if values is not None:
+            if await self.in_settings(guild):
                 return
             else:
                 await self.addserv(guild, mode=mode, items=items, ecc=ecc, nil=True)
 
     async def in_settings(self, guild):
-        req = f"""SELECT * FROM servdata WHERE UUID = {guild.id}"""
-        async with self.conn.acquire() as connection:
-            return bool(await connection.fetchval(req))
+        if self.settings_cache.get(guild.id) is not None:
+            return True
+        return bool(await self.db.fetchval("in_settings", guild.id))
 
     async def get_settings(self, guild):
+        """The guild's settings. The cache holds the JSON rather than the dict, so every caller
+        gets its own copy and edits only reach the cache through update_settings"""
+        value = self.settings_cache.get(guild.id)
+        if value is not None:
+            return json.loads(value)
+
         try:
-            req = f"""SELECT info FROM servdata WHERE UUID = {guild.id}"""
-            async with self.conn.acquire() as connection:
-                value = await connection.fetchval(req)
+            value = await self.db.fetchval("get_settings", guild.id)
             if value is not None:
-                data = json.loads(value)
-                return data
+                self.settings_cache[guild.id] = value
+                return json.loads(value)
 
             else:
                 await self.addserv(guild, nil=True)
@@ -116,95 +129,143 @@ class RPG(object):
         except:
             print_exc()
 
+    async def ctx_settings(self, ctx):
+        """Get the settings for ctx.guild, looked up once per invocation and shared through ctx"""
+        settings = getattr(ctx, "settings", None)
+        if settings is None:
+            settings = ctx.settings = await self.get_settings(ctx.guild)
+        return settings
+
     async def update_settings(self, guild, settings):
         try:
-            json_data = json.dumps(settings).replace("'", "''")
-            req = f"""UPDATE servdata
-                      SET info = '{json_data}'
-                      WHERE UUID = {guild.id}"""
-
-            async with self.conn.acquire() as connection:
-                await connection.fetchval(req)
+            value = json.dumps(settings)
+            await self.db.execute("update_settings", guild.id, value)
+            self.settings_cache[guild.id] = value
         except:
-            print(json_data)
-
-    async def get_full_inv(self, member):
-        async with self.conn.acquire() as connection:
-            value = await connection.fetchval(
-            """
-            SELECT info FROM userdata WHERE UUID = {member.id};
-            """.format(member=member))
-
-        if value is None:
-            rd = dict(items=dict(), money=0)
-            data = {str(member.guild.id): rd}
-            async with self.conn.acquire() as connection:
-                await connection.fetchval("""
-                INSERT INTO userdata (UUID, info) VALUES ({member.id}, '{json_data}');
-            """.format(member=member, json_data=json.dumps(data)))
-
-        else:
-            data = json.loads(value)
-            try:
-                itm = data[str(member.guild.id)]
-                itm["items"] = {x: y for x, y in itm["items"].items() if y}
-
-            except KeyError:
-                rd = dict(items=dict(), money=0)
-                data[str(member.guild.id)] = rd
+            self.settings_cache.pop(guild.id)
+            print_exc()
 
-            async with self.conn.acquire() as connection:
-                await connection.fetchval("""UPDATE userdata
-            SET info = '{json_data}'
-            WHERE UUID = {member.id};""".format(member=member, json_data=json.dumps(data)))
+    def __unload(self):
+        self.lottery_scheduler.stop()
+
+    async def setup(self):
+        """Create the economy tables, migrating the old userdata blobs the first time,
+        and reschedule any lotteries that were running"""
+        async with self.db.acquire() as connection:
+            async with connection.transaction():
+                exists = await self.db.fetchval("table_exists", "economy", connection=connection)
+                await connection.execute(SCHEMA)
+                if exists is None:
+                    await self.migrate_userdata(connection)
+
+        self.lottery_scheduler.clear()
+        for record in await self.db.fetch("all_lotteries"):
+            if self.bot.get_guild(record["guild"]) is not None:
+                self.lottery_scheduler.schedule(record["ends"], (record["guild"], record["name"]))
+
+    async def migrate_userdata(self, connection):
+        """Split every userdata JSON blob into per (user, guild, item) rows"""
+        balances = []
+        items = []
+        for record in await self.db.fetch("get_userdata_blobs", connection=connection):
+            for guild, data in json.loads(record["info"]).items():
+                balances.append((record["uuid"], int(guild), max(data.get("money", 0), 0)))
+                items.extend((record["uuid"], int(guild), item, count)
+                             for item, count in data.get("items", {}).items() if count > 0)
+
+        await self.db.executemany("migrate_balance", balances, connection=connection)
+        await self.db.executemany("migrate_item", items, connection=connection)
 
+    async def get_full_inv(self, member):
+        """Get a member's inventory for every guild, keyed by guild id"""
+        data = await self.db.get_full_inv(member.id)
+        data.setdefault(str(member.guild.id), dict(items=dict(), money=0))
         return data
 
     async def get_inv(self, member):
-        return (await self.get_full_inv(member))[str(member.guild.id)]
+        async with self.db.acquire() as connection:
+            money = await self.db.fetchval("get_eco", member.id, member.guild.id, connection=connection)
+            items = await self.db.fetch("get_items", member.id, member.guild.id, connection=connection)
+
+        return dict(items={record["item"]: record["count"] for record in items}, money=money or 0)
+
+    async def change_inv(self, member, items):
+        """Atomically add (or with negative counts, take) items from a member, returning the new counts.
+        Raises ValueError if any count would go below zero, in which case nothing is changed"""
+        credits = {item: count for item, count in items.items() if count >= 0}
+        debits = {item: count for item, count in items.items() if count < 0}
+        async with self.db.acquire() as connection:
+            async with connection.transaction():
+                values = []
+                if debits:
+                    values = await self.db.fetch("take_inv", member.id, member.guild.id,
+                                                 list(debits.keys()), list(debits.values()), connection=connection)
+                    if len(values) != len(debits):
+                        raise ValueError("User does not have enough items to take")  # Rolls the transaction back
+                if credits:
+                    values += await self.db.fetch("change_inv", member.id, member.guild.id,
+                                                  list(credits.keys()), list(credits.values()), connection=connection)
+
+        return {record["item"]: record["count"] for record in values}
 
     async def add_inv(self, member, *items):
-        data = await self.get_full_inv(member)
-        data[str(member.guild.id)]["items"] = Counter(data[str(member.guild.id)]["items"])
-        data[str(member.guild.id)]["items"].update(dict(items))
-
-        command = """UPDATE userdata
-           SET info = '{json_data}'
-           WHERE UUID = {member.id};""".format(json_data=json.dumps(data), member=member)
-        async with self.conn.acquire() as connection:
-            await connection.fetchval(command)
+        changes = Counter()
+        for item, count in items:
+            changes[item] += count
+        return await self.change_inv(member, changes)
 
     async def get_eco(self, member):
-        return (await self.get_inv(member))["money"]
+        return await self.db.fetchval("get_eco", member.id, member.guild.id) or 0
 
     async def add_eco(self, member, amount):
-        data = await self.get_full_inv(member)
-        data[str(member.guild.id)]["money"] += amount
-        if data[str(member.guild.id)]["money"] < 0:
+        """Add (or with a negative amount, take) money, returning the new balance.
+        Raises ValueError if the member can't afford it"""
+        if amount >= 0:
+            return await self.db.fetchval("add_eco", member.id, member.guild.id, amount)
+        money = await self.db.fetchval("take_eco", member.id, member.guild.id, amount)
+        if money is None:
             raise ValueError("Cannot take more than user has")
-        command = """UPDATE userdata
-           SET info = '{json_data}'
-           WHERE UUID = {member.id};""".format(json_data=json.dumps(data).replace("'", "''"), member=member)
-
-        async with self.conn.acquire() as connection:
-            values = await connection.fetchval(command)
+        return money
 
     async def remove_inv(self, member, *items):
-        data = await self.get_full_inv(member)
-        id = dict(items)
-        data[str(member.guild.id)]["items"] = Counter(data[str(member.guild.id)]["items"])
-        data[str(member.guild.id)]["items"].subtract(id)
-
-        for item, value in data[str(member.guild.id)]["items"].items():
-            if item in id:
-                if value < 0:
-                    raise ValueError("User does not have enough items to take")
-
-        command = """UPDATE userdata
-           SET info = '{json_data}'
-           WHERE UUID = {member.id};""".format(json_data=json.dumps(data), member=member)
-        async with self.conn.acquire() as connection:
-            await connection.fetchval(command)
+        changes = Counter()
+        for item, count in items:
+            changes[item] -= count
+        return await self.change_inv(member, changes)
+
+    async def add_inv_bulk(self, guild, ids, item, count):
+        return len(await self.db.fetch("add_inv_bulk", ids, guild.id, item, count))
+
+    async def remove_inv_bulk(self, guild, ids, item, count):
+        """Take items from every member that has enough of them, skipping the rest"""
+        return len(await self.db.fetch("remove_inv_bulk", ids, guild.id, item, count))
+
+    async def add_eco_bulk(self, guild, ids, amount):
+        """Give every member amount, skipping members who would go negative"""
+        return len(await self.db.fetch("take_eco_bulk" if amount < 0 else "add_eco_bulk", ids, guild.id, amount))
+
+    async def set_eco_bulk(self, guild, ids, amount):
+        try:
+            return len(await self.db.fetch("set_eco_bulk", ids, guild.id, amount))
+        except asyncpg.CheckViolationError:
+            raise ValueError("Balance cannot be negative")
+
+    async def bulk_apply(self, ctx, members, mutation, *args):
+        """Apply one of the *_bulk mutations to members BULK_CHUNK at a time, reporting progress
+        Returns the number of members changed and the time taken in seconds"""
+        ids = list({member.id for member in members})
+        start = perf_counter()
+        progress = None
+        affected = 0
+        for index in range(0, len(ids), BULK_CHUNK):
+            affected += await mutation(ctx.guild, ids[index:index + BULK_CHUNK], *args)
+            done = min(index + BULK_CHUNK, len(ids))
+            if progress is not None:
+                await progress.edit(content="Processed {}/{} members".format(done, len(ids)))
+            elif done < len(ids):
+                progress = await ctx.send("Processed {}/{} members".format(done, len(ids)))
+
+        return affected, perf_counter() - start
 
     @commands.group(invoke_without_command=True, aliases=['i', 'inv'])
     @checks.no_pm()
@@ -237,11 +298,10 @@ class RPG(object):
         if "everyone" in members:
             members = ctx.guild.members
         num = abs(num)
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if settings["mode"] == 0 or item in settings["items"]:
-            for member in members:
-                await self.add_inv(member, (item, num))
-            await ctx.send("Items given!")
+            affected, elapsed = await self.bulk_apply(ctx, members, self.add_inv_bulk, item, num)
+            await ctx.send("Items given to {} members in {:.2f}s!".format(affected, elapsed))
 
         else:
             await ctx.send("Item is not available! (Add it or switch to simple mode)")
@@ -256,14 +316,13 @@ class RPG(object):
         if "everyone" in members:
             members = ctx.guild.members
         num = abs(num)
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if settings["mode"] == 0 or item in settings["items"]:
-            for member in members:
-                try:
-                    await self.remove_inv(member, (item, num))
-                    await ctx.send("Items taken!")
-                except ValueError:
-                    await ctx.send("Could not take item from {}! Skipping".format(member))
+            affected, elapsed = await self.bulk_apply(ctx, members, self.remove_inv_bulk, item, num)
+            await ctx.send("Items taken from {} members in {:.2f}s!".format(affected, elapsed))
+            skipped = len(set(members)) - affected
+            if skipped:
+                await ctx.send("{} members did not have enough {}, skipped".format(skipped, item))
         else:
             await ctx.send("Item is not available! (Add it or switch to simple mode)")
 
@@ -395,7 +454,7 @@ class RPG(object):
     @server_complex_mode
     async def items(self, ctx):
         """See all items for a guild"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         items = settings['items']
         if not items:
             await ctx.send("No items to display")
@@ -427,7 +486,7 @@ class RPG(object):
         """Get your balance"""
         if not member:
             member = ctx.author
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         val = await self.get_eco(member)
         fmt = "You have {} {}".format(val, settings['cur'])
         embed = discord.Embed(description=fmt)
@@ -446,10 +505,11 @@ class RPG(object):
         if "everyone" in members:
             members = ctx.guild.members
 
-        for member in members:
-            await self.add_eco(member, amount)
-
-        await ctx.send("Money given!")
+        affected, elapsed = await self.bulk_apply(ctx, members, self.add_eco_bulk, amount)
+        await ctx.send("Money given to {} members in {:.2f}s!".format(affected, elapsed))
+        skipped = len(set(members)) - affected
+        if skipped:
+            await ctx.send("{} members did not have enough money, skipped".format(skipped))
 
     @checks.mod_or_permissions()
     @economy.command(aliases=["setbal"])
@@ -460,11 +520,13 @@ class RPG(object):
         if "everyone" in members:
             members = ctx.guild.members
 
-        for member in members:
-            bal = await self.get_eco(member)
-            await self.add_eco(member, amount-bal)
+        try:
+            affected, elapsed = await self.bulk_apply(ctx, members, self.set_eco_bulk, amount)
+        except ValueError:
+            await ctx.send("Balance cannot be negative!")
+            return
 
-        await ctx.send("Balance changed!")
+        await ctx.send("Balance changed for {} members in {:.2f}s!".format(affected, elapsed))
 
     @economy.command()
     @checks.no_pm()
@@ -473,7 +535,6 @@ class RPG(object):
         """Sell items to another player for a set amount. (Using {item}x{#}
         Example: ;i sellto @Henry#6174 50 bananax3"""
         oinv = await self.get_inv(ctx.author)
-        uinv = await self.get_inv(user)
         sitems = []
         for item in items:
             split = item.split('x')
@@ -490,12 +551,19 @@ class RPG(object):
 
         if msg.content == ";accept":
             await ctx.send("Accepted!")
-            if uinv["money"] < amount:
+            try:
+                await self.add_eco(user, -amount)
+            except ValueError:
                 await ctx.send("You cannot afford to accept this deal! Cancelled")
                 return
+            try:
+                await self.remove_inv(ctx.author, *sitems)
+            except ValueError:
+                await self.add_eco(user, amount)
+                await ctx.send("You no longer have the items to sell! Cancelled")
+                return
             await self.add_inv(user, *sitems)
             await self.add_eco(ctx.author, amount)
-            await self.add_eco(user, -amount)
             await ctx.send("Exchange Completed")
         else:
             await ctx.send("Declined! Cancelling")
@@ -506,7 +574,7 @@ class RPG(object):
     async def sell(self, ctx, item: str, num: int):
         """If item has a set value, sell x of the item"""
         num = abs(num)
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if item in settings['items']:
             if settings['items'][item].get("sellvalue", None):
                 try:
@@ -528,15 +596,15 @@ class RPG(object):
         """If item has a set value, buy x of the item"""
         try:
             num = abs(num)
-            settings = await self.get_settings(ctx.guild)
+            settings = await self.ctx_settings(ctx)
             if item in settings['items']:
                 if settings['items'][item].get("buyvalue", None):
                     try:
                         val = int(settings['items'][item].get("buyvalue", None)) * num
-                        await self.add_inv(ctx.author, (item, num))
                         await self.add_eco(ctx.author, -val)
+                        await self.add_inv(ctx.author, (item, num))
                         await ctx.send("{} {}s bought for ${}".format(num, item, val))
-                    except IndexError:
+                    except ValueError:
                         await ctx.send("You cant afford to buy this!")
                 else:
                     await ctx.send("This item has no set value!")
@@ -550,12 +618,13 @@ class RPG(object):
     @server_eco_mode
     async def pay(self, ctx, amount: int, other: discord.Member):
         """Pay another user an amount"""
-        if await self.get_eco(ctx.author) < amount:
+        try:
+            await self.add_eco(ctx.author, -abs(amount))
+        except ValueError:
             await ctx.send("You don't have enough money to use this command!")
         else:
-            await self.add_eco(ctx.author, -abs(amount))
             await self.add_eco(other, abs(amount))
-            await ctx.send("Successfully paid {} {} to {}".format(abs(amount), (await self.get_settings(ctx.guild))["cur"], other))
+            await ctx.send("Successfully paid {} {} to {}".format(abs(amount), (await self.ctx_settings(ctx))["cur"], other))
 
     @checks.mod_or_permissions()
     @commands.group(name="settings", aliases=["s", "stgs"], invoke_without_command=True)
@@ -563,7 +632,7 @@ class RPG(object):
     async def _settings(self, ctx):
         """Get the servers settings
         Requires "Bot Mod" role"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
 
         embed = discord.Embed()
         embed.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon_url)
@@ -628,7 +697,7 @@ class RPG(object):
             val = ": ".join(split[1:])
             fdict[key] = val
 
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         settings['items'][name] = fdict
         await ctx.send("Added item {}".format(name))
         await self.update_settings(ctx.guild, settings)
@@ -640,7 +709,7 @@ class RPG(object):
     async def removeitem(self, ctx, name: str):
         """Remove an item that can be given, inverse of ;i additem
         Requires "Bot Mod" role"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if name in settings['items']:
             del settings['items'][name]
 
@@ -657,7 +726,7 @@ class RPG(object):
     async def addinfo(self, ctx, item: str, *, new_data):
         """Add new info data to an item, same syntax as editinfo and additem
         Requires "Bot Mod" role"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if item not in settings["items"]:
             await ctx.send("That is not a valid item!")
             return
@@ -678,7 +747,7 @@ class RPG(object):
     async def setcurrency(self, ctx, currency: str):
         """Change the servers currency for example 'Gold', etc
         Requires "Bot Mod" role"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         old = settings['cur']
         settings['cur'] = currency
         await ctx.send("Currency changed from {} to {}".format(old, currency))
@@ -692,7 +761,7 @@ class RPG(object):
     async def setstartamount(self, ctx, amount: int):
         """Set the amount of money users start with
         Requires "Bot Mod" role"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         settings["start"] = amount
         await ctx.send("Players will now join the server with {} {}".format(amount, settings["cur"]))
         await self.update_settings(ctx.guild, settings)
@@ -702,7 +771,7 @@ class RPG(object):
     @server_complex_mode
     async def iteminfo(self, ctx, item: str):
         """Get metadata for an item"""
-        servsetting = await self.get_settings(ctx.guild)
+        servsetting = await self.ctx_settings(ctx)
         items = servsetting['items']
         desc = ""
         if item not in items:
@@ -739,7 +808,7 @@ class RPG(object):
     async def configure(self, ctx):
         """Configure the server's inventory settings
         Requires "Bot Admin" role"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
 
         desc = """To toggle complex inventory emote with :baggage_claim:
                To toggle eco mode emote with :dollar:
@@ -849,19 +918,20 @@ class RPG(object):
     @server_eco_mode
     async def lotto(self, ctx):
         """List the currently running lottos."""
-        if ctx.guild.id in self.lotteries:
+        lotteries = await self.db.fetch("get_lotteries", ctx.guild.id)
+        if lotteries:
             embed = discord.Embed()
             embed.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon_url)
             embed.set_thumbnail(
                 url="https://mir-s3-cdn-cf.behance.net/project_modules/disp/196b9d18843737.562d0472d523f.png"
             )
-            settings = await self.get_settings(ctx.guild)
+            settings = await self.ctx_settings(ctx)
             cur = settings["cur"]
 
-            for lotto, value in self.lotteries[ctx.guild.id].items():
-                embed.add_field(name=lotto,
-                                value="Jackpot: {} {}\n{} players entered".format(value["jackpot"],
-                                                                                  cur, len(value["players"])))
+            for lotto in lotteries:
+                embed.add_field(name=lotto["name"],
+                                value="Jackpot: {} {}\n{} players entered".format(lotto["jackpot"],
+                                                                                  cur, lotto["entrants"]))
             embed.set_footer(text=str(ctx.message.created_at))
 
             await ctx.send(embed=embed)
@@ -875,39 +945,44 @@ class RPG(object):
     async def new(self, ctx, name: str, jackpot: int, time: int):
         """Create a new lotto, with jackpot payout lasting time in seconds
         Requires "Bot Mod" role"""
-        if ctx.guild.id not in self.lotteries:
-            self.lotteries[ctx.guild.id] = dict()
-        if name in self.lotteries[ctx.guild.id]:
+        ends = datetime.datetime.utcnow() + datetime.timedelta(seconds=time)
+        if await self.db.fetchval("add_lottery", ctx.guild.id, name, jackpot, ctx.channel.id, ends) is None:
             await ctx.send("A lottery of that name already exists!")
             return
-        current = dict(jackpot=jackpot, players=list(), channel=ctx.channel)
-        self.lotteries[ctx.guild.id][name] = current
+        self.lottery_scheduler.schedule(ends, (ctx.guild.id, name))
         await ctx.send("Lottery created!")
-        await asyncio.sleep(time)
-        if current["players"]:
-            winner = choice(current["players"])
-            await self.add_eco(winner, current["jackpot"])
-            await current["channel"].send("Lottery {} is now over!\n{} won {}! Congratulations!".format(name, winner.mention, current["jackpot"]))
-        else:
-            await ctx.send("Nobody entered {}! Its over now.".format(name))
-        del self.lotteries[ctx.guild.id][name]
+
+    async def finish_lottery(self, key):
+        """Called by the lottery scheduler when a lottery's time is up"""
+        guild_id, name = key
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return
+        record = await self.db.fetchrow("finish_lottery", guild_id, name)
+        if record is None:
+            return
+
+        channel = guild.get_channel(record["channel"])
+        players = [member for member in map(guild.get_member, record["players"]) if member is not None]
+        if players:
+            winner = choice(players)
+            await self.add_eco(winner, record["jackpot"])
+            if channel is not None:
+                await channel.send("Lottery {} is now over!\n{} won {}! Congratulations!".format(name, winner.mention, record["jackpot"]))
+        elif channel is not None:
+            await channel.send("Nobody entered {}! Its over now.".format(name))
 
     @lotto.command(aliases=["join"])
     @checks.no_pm()
     @server_eco_mode
     async def enter(self, ctx, name: str):
         """Enter the lottery with the given name."""
-        if ctx.guild.id in self.lotteries:
-            if name in self.lotteries[ctx.guild.id]:
-                if ctx.author not in self.lotteries[ctx.guild.id][name]["players"]:
-                    self.lotteries[ctx.guild.id][name]["players"].append(ctx.author)
-                    await ctx.send("Lotto entered!")
-                else:
-                    await ctx.send("You're already in this lotto!")
-            else:
-                await ctx.send("This server has no lotto by that name! See ;lotto")
+        if await self.db.fetchval("enter_lottery", ctx.guild.id, name, ctx.author.id) is not None:
+            await ctx.send("Lotto entered!")
+        elif await self.db.fetchval("lottery_exists", ctx.guild.id, name):
+            await ctx.send("You're already in this lotto!")
         else:
-            await ctx.send("This server has no lottos currently running!")
+            await ctx.send("This server has no lotto by that name! See ;lotto")
 
     @commands.command(aliases=["rollthedice", "dice"])
     async def rtd(self, ctx, *dice: str):
@@ -960,7 +1035,7 @@ class RPG(object):
     @commands.group(invoke_without_command=True, aliases=['box'])
     @server_eco_mode
     async def lootbox(self, ctx):
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if settings["lootboxes"]:
             embed = discord.Embed()
             embed.set_author(name=ctx.guild.name, icon_url=ctx.guild.icon_url)
@@ -989,11 +1064,11 @@ class RPG(object):
         Use {item}x{#} notation to add items with {#} weight
         Weight being an integer. For example:
         bananax2 orangex3. The outcome of the box will be
-        Random Choice[banana, banana, orange, orange, orange]
+        banana 2/5 of the time and orange 3/5 of the time
         
         Requires "Bot Mod" role"""
 
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if name in settings["lootboxes"]:
             await ctx.send("Lootbox already exists, updating...")
 
@@ -1003,8 +1078,13 @@ class RPG(object):
             split, num = "x".join(split[:-1]), abs(int(split[-1]))
             winitems.update({split: num})
 
+        try:
+            table = AliasTable.from_weights(winitems)
+        except ValueError:
+            await ctx.send("A lootbox needs at least one item with a weight above 0!")
+            return
 
-        settings["lootboxes"][name] = dict(cost=cost, items=winitems)
+        settings["lootboxes"][name] = dict(cost=cost, items=winitems, table=table.to_dict())
 
         await ctx.send("Lootbox successfully created")
         await self.update_settings(ctx.guild, settings)
@@ -1012,39 +1092,44 @@ class RPG(object):
     @checks.no_pm()
     @lootbox.command(name="buy")
     @server_eco_mode
-    async def _buy(self, ctx, name: str):
-        """Buy a lootbox of the given name"""
-        settings = await self.get_settings(ctx.guild)
+    async def _buy(self, ctx, name: str, num: int=1):
+        """Buy a lootbox of the given name, or open `num` of them at once"""
+        if not 1 <= num <= MAX_LOOTBOXES:
+            await ctx.send("You can open between 1 and {} boxes at a time".format(MAX_LOOTBOXES))
+            return
+        settings = await self.ctx_settings(ctx)
         try:
             box = settings["lootboxes"][name]
         except KeyError:
             await ctx.send("That is not a valid lootbox")
             return
 
-        bal = await self.get_eco(ctx.author)
-        if bal < box["cost"]:
-            await ctx.send("You cant afford this box")
+        try:
+            await self.add_eco(ctx.author, -box["cost"] * num)
+        except ValueError:
+            await ctx.send("You cant afford this box" if num == 1 else "You cant afford that many boxes")
             return
 
-        await self.add_eco(ctx.author, box["cost"])
-        winitems = []
-        for item, amount in box["items"].items():
-            winitems += [item] * amount
+        if "table" not in box:  # Boxes made before tables were compiled on creation
+            box["table"] = AliasTable.from_weights(box["items"]).to_dict()
+        table = AliasTable.from_dict(box["table"])
 
-        result = choice(winitems)
-        await self.add_inv(ctx.author, (result, 1))
-        await ctx.send("You won a(n) {}".format(result))
+        results = Counter(table.draw() for _ in range(num))
+        await self.add_inv(ctx.author, *results.items())
+        if num == 1:
+            await ctx.send("You won a(n) {}".format(next(iter(results))))
+        else:
+            await ctx.send("You won {}".format(" ".join("{}x{}".format(item, count) for item, count in results.items())))
 
     @checks.no_pm()
     @lootbox.command(name="delete", aliases=["remove"])
     @server_eco_mode
     async def _delete(self, ctx, name: str):
         """Delete a lootbox with the given name"""
-        settings = await self.get_settings(ctx.guild)
+        settings = await self.ctx_settings(ctx)
         if name in settings["lootboxes"]:
             del settings["lootboxes"][name]
+            await self.update_settings(ctx.guild, settings)
             await ctx.send("Loot box removed")
         else:
             await ctx.send("Invalid loot box")
-
-            await self.update_settings(ctx.guild, settings)
\ No newline at end of file
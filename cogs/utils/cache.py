@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from time import monotonic
+
+
+class TTLCache(object):
+    """A bounded LRU mapping whose entries also expire `ttl` seconds after being set.
+    Counts hits and misses so callers can tell how well it is doing"""
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires < monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data),
+                    ratio=self.hits / total if total else 0.0)
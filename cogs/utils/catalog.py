@@ -0,0 +1,79 @@
+import asyncio
+from random import choice
+from time import monotonic
+from traceback import print_exc
+from bs4 import BeautifulSoup
+
+CATALOG_URL = "https://a.4cdn.org/{}/catalog.json"
+
+
+def parse_catalog(data, limit=2000):
+    """The text of every thread's opening post, ready to send. This blocks, run it in an executor"""
+    texts = []
+    for page in data:
+        for thread in page.get("threads", ()):
+            html = thread.get("com")
+            if not html:
+                continue
+            text = BeautifulSoup(html, 'html.parser').get_text().strip()
+            if text:
+                texts.append(text[:limit])
+    return texts
+
+
+class CatalogPool(object):
+    """Keeps a parsed pool of thread texts for every board that's been asked for.
+    Each board is refreshed every `interval` seconds by its own task, which stops
+    (dropping the pool) once nobody has asked for the board in `idle` seconds"""
+    def __init__(self, fetcher, loop=None, interval=120, idle=1800):
+        self.fetcher = fetcher
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.idle = idle
+        self.pools = dict()
+        self.last_used = dict()
+        self._loaded = dict()
+        self._tasks = dict()
+
+    async def get(self, board):
+        """A random thread's text from `board`, only waiting on the network the first time. May return None"""
+        self.last_used[board] = monotonic()
+        if board not in self._tasks:
+            self._loaded[board] = asyncio.Event()
+            self._tasks[board] = self.loop.create_task(self._run(board))
+        await self._loaded[board].wait()
+        texts = self.pools.get(board)
+        return choice(texts) if texts else None
+
+    async def refresh(self, board, previous=None):
+        response = await self.fetcher.get(CATALOG_URL.format(board), ttl=self.interval)
+        if response.status != 200:
+            raise LookupError("No catalog for /{}/ ({})".format(board, response.status))
+        if response is not previous:  # A 304 hands back the response we already parsed
+            self.pools[board] = await self.loop.run_in_executor(None, parse_catalog, response.json())
+        return response
+
+    async def _run(self, board):
+        response = None
+        try:
+            while monotonic() - self.last_used[board] < self.idle:
+                try:
+                    response = await self.refresh(board, response)
+                except LookupError:
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    print_exc()  # Keep serving the old pool, try again next time
+                finally:
+                    self._loaded[board].set()
+                await asyncio.sleep(self.interval)
+        finally:  # Forget the board entirely, names come straight from ;fchan
+            self._loaded.pop(board).set()
+            del self._tasks[board]
+            self.last_used.pop(board, None)
+            self.pools.pop(board, None)
+
+    def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
@@ -0,0 +1,190 @@
+"""Named, parameterized queries shared by the cogs and the web server.
+Every statement is sent with its arguments as bind parameters, so asyncpg
+prepares each one once per pooled connection and reuses the cached plan."""
+from time import perf_counter
+
+# asyncpg.create_pool arguments, for the bot and the cluster launcher's web server alike
+CONNECTION = dict(user='root', password='root', database='typheus', host='127.0.0.1')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS economy (
+    UUID BIGINT NOT NULL,
+    guild BIGINT NOT NULL,
+    money BIGINT NOT NULL DEFAULT 0 CHECK (money >= 0),
+    PRIMARY KEY (UUID, guild)
+);
+CREATE TABLE IF NOT EXISTS inventory (
+    UUID BIGINT NOT NULL,
+    guild BIGINT NOT NULL,
+    item TEXT NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0 CHECK (count >= 0),
+    PRIMARY KEY (UUID, guild, item)
+);
+CREATE INDEX IF NOT EXISTS inventory_guild_item ON inventory (guild, item);
+CREATE TABLE IF NOT EXISTS lotteries (
+    guild BIGINT NOT NULL,
+    name TEXT NOT NULL,
+    jackpot BIGINT NOT NULL,
+    channel BIGINT NOT NULL,
+    ends TIMESTAMP NOT NULL,
+    players BIGINT[] NOT NULL DEFAULT '{}',
+    PRIMARY KEY (guild, name)
+);
+CREATE TABLE IF NOT EXISTS markov_voices (
+    guild BIGINT PRIMARY KEY,
+    voice TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS markov_learning (
+    channel BIGINT PRIMARY KEY,
+    guild BIGINT NOT NULL
+);
+"""
+
+STATEMENTS = dict(
+    table_exists="""SELECT to_regclass($1::TEXT)""",
+
+    # Guild settings
+    in_settings="""SELECT 1 FROM servdata WHERE UUID = $1""",
+    get_settings="""SELECT info FROM servdata WHERE UUID = $1""",
+    add_settings="""INSERT INTO servdata (UUID, info) VALUES ($1, $2)""",
+    update_settings="""UPDATE servdata SET info = $2 WHERE UUID = $1""",
+
+    # Old per-user blobs, only read when migrating
+    get_userdata_blobs="""SELECT UUID, info FROM userdata""",
+    migrate_balance="""
+    INSERT INTO economy (UUID, guild, money) VALUES ($1, $2, $3)
+    ON CONFLICT DO NOTHING""",
+    migrate_item="""
+    INSERT INTO inventory (UUID, guild, item, count) VALUES ($1, $2, $3, $4)
+    ON CONFLICT DO NOTHING""",
+
+    # Single member economy
+    get_balances="""SELECT guild, money FROM economy WHERE UUID = $1""",
+    get_all_items="""SELECT guild, item, count FROM inventory WHERE UUID = $1 AND count > 0""",
+    get_eco="""SELECT money FROM economy WHERE UUID = $1 AND guild = $2""",
+    get_items="""SELECT item, count FROM inventory WHERE UUID = $1 AND guild = $2 AND count > 0""",
+    # Upserts only ever credit, CHECK constraints are tested against the proposed row before
+    # ON CONFLICT is resolved, so a negative insert fails however much the member already has.
+    # Debits go through the conditional UPDATEs instead
+    change_inv="""
+    INSERT INTO inventory (UUID, guild, item, count)
+         SELECT $1, $2, item, count FROM unnest($3::TEXT[], $4::BIGINT[]) AS changes (item, count)
+    ON CONFLICT (UUID, guild, item) DO UPDATE SET count = inventory.count + EXCLUDED.count
+      RETURNING item, count""",
+    take_inv="""
+    UPDATE inventory SET count = inventory.count + changes.count
+      FROM unnest($3::TEXT[], $4::BIGINT[]) AS changes (item, count)
+     WHERE inventory.UUID = $1 AND inventory.guild = $2 AND inventory.item = changes.item
+       AND inventory.count + changes.count >= 0
+     RETURNING inventory.item, inventory.count""",
+    add_eco="""
+    INSERT INTO economy (UUID, guild, money) VALUES ($1, $2, $3)
+    ON CONFLICT (UUID, guild) DO UPDATE SET money = economy.money + EXCLUDED.money
+      RETURNING money""",
+    take_eco="""
+    UPDATE economy SET money = money + $3
+     WHERE UUID = $1 AND guild = $2 AND money + $3 >= 0
+     RETURNING money""",
+
+    # Many members at once, $1 is always an array of member ids
+    add_inv_bulk="""
+    INSERT INTO inventory (UUID, guild, item, count)
+         SELECT UUID, $2, $3, $4 FROM unnest($1::BIGINT[]) AS members (UUID)
+    ON CONFLICT (UUID, guild, item) DO UPDATE SET count = inventory.count + EXCLUDED.count
+      RETURNING UUID""",
+    remove_inv_bulk="""
+    UPDATE inventory SET count = count - $4
+     WHERE UUID = ANY($1::BIGINT[]) AND guild = $2 AND item = $3 AND count >= $4
+     RETURNING UUID""",
+    add_eco_bulk="""
+    INSERT INTO economy (UUID, guild, money)
+         SELECT UUID, $2, $3 FROM unnest($1::BIGINT[]) AS members (UUID)
+    ON CONFLICT (UUID, guild) DO UPDATE SET money = economy.money + EXCLUDED.money
+      RETURNING UUID""",
+    take_eco_bulk="""
+    UPDATE economy SET money = money + $3
+     WHERE UUID = ANY($1::BIGINT[]) AND guild = $2 AND money + $3 >= 0
+     RETURNING UUID""",
+    set_eco_bulk="""
+    INSERT INTO economy (UUID, guild, money)
+         SELECT UUID, $2, $3 FROM unnest($1::BIGINT[]) AS members (UUID)
+    ON CONFLICT (UUID, guild) DO UPDATE SET money = EXCLUDED.money
+      RETURNING UUID""",
+
+    # Markov voices and learning channels
+    get_markov_voices="""SELECT guild, voice FROM markov_voices""",
+    get_markov_learning="""SELECT channel, guild FROM markov_learning""",
+    set_markov_voice="""
+    INSERT INTO markov_voices (guild, voice) VALUES ($1, $2)
+    ON CONFLICT (guild) DO UPDATE SET voice = EXCLUDED.voice""",
+    add_markov_learning="""
+    INSERT INTO markov_learning (channel, guild) VALUES ($1, $2)
+    ON CONFLICT DO NOTHING""",
+    remove_markov_learning="""DELETE FROM markov_learning WHERE channel = $1""",
+
+    # Lotteries
+    all_lotteries="""SELECT guild, name, ends FROM lotteries""",
+    get_lotteries="""SELECT name, jackpot, cardinality(players) AS entrants FROM lotteries WHERE guild = $1""",
+    lottery_exists="""SELECT 1 FROM lotteries WHERE guild = $1 AND name = $2""",
+    add_lottery="""
+    INSERT INTO lotteries (guild, name, jackpot, channel, ends) VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT DO NOTHING
+      RETURNING name""",
+    enter_lottery="""
+    UPDATE lotteries SET players = array_append(players, $3)
+     WHERE guild = $1 AND name = $2 AND NOT $3 = ANY(players)
+     RETURNING name""",
+    finish_lottery="""DELETE FROM lotteries WHERE guild = $1 AND name = $2 RETURNING jackpot, channel, players""",
+)
+
+
+class Database(object):
+    """Runs STATEMENTS by name against an asyncpg pool.
+    Pass connection= to run inside an already acquired connection or transaction"""
+    def __init__(self, pool, metrics=None):
+        self.pool = pool
+        self.metrics = metrics
+
+    def acquire(self):
+        return self.pool.acquire()
+
+    async def _run(self, method, name, args, connection):
+        start = perf_counter()
+        try:
+            if connection is not None:
+                return await getattr(connection, method)(STATEMENTS[name], *args)
+            async with self.pool.acquire() as connection:
+                return await getattr(connection, method)(STATEMENTS[name], *args)
+        except Exception as error:
+            if self.metrics is not None:
+                self.metrics.query_error(name, error)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_query(name, perf_counter() - start)
+
+    async def fetch(self, name, *args, connection=None):
+        return await self._run("fetch", name, args, connection)
+
+    async def fetchrow(self, name, *args, connection=None):
+        return await self._run("fetchrow", name, args, connection)
+
+    async def fetchval(self, name, *args, connection=None):
+        return await self._run("fetchval", name, args, connection)
+
+    async def execute(self, name, *args, connection=None):
+        return await self._run("execute", name, args, connection)
+
+    async def executemany(self, name, args, connection=None):
+        return await self._run("executemany", name, (args,), connection)
+
+    async def get_full_inv(self, snowflake):
+        """Get a user's inventory and balance for every guild, keyed by guild id"""
+        async with self.pool.acquire() as connection:
+            balances = await self.fetch("get_balances", snowflake, connection=connection)
+            items = await self.fetch("get_all_items", snowflake, connection=connection)
+
+        data = {str(record["guild"]): dict(items=dict(), money=record["money"]) for record in balances}
+        for record in items:
+            data.setdefault(str(record["guild"]), dict(items=dict(), money=0))["items"][record["item"]] = record["count"]
+        return data
@@ -0,0 +1,109 @@
+import asyncio
+import async_timeout
+import ujson as json
+from collections import OrderedDict
+from time import monotonic
+
+
+class Response(object):
+    """A fully read response. The same object is handed to every caller it's cached for, don't modify it"""
+    __slots__ = ("url", "status", "headers", "body", "expires", "_json")
+
+    def __init__(self, url, status, headers, body, expires=0.0):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self._json = None
+
+    @property
+    def etag(self):
+        return self.headers.get("ETag")
+
+    @property
+    def last_modified(self):
+        return self.headers.get("Last-Modified")
+
+    def text(self, encoding="utf-8"):
+        return self.body.decode(encoding, "replace")
+
+    def json(self):
+        """The parsed body, only parsed once however many callers share the response"""
+        if self._json is None:
+            self._json = json.loads(self.body)
+        return self._json
+
+
+class FetchClient(object):
+    """GETs through a shared aiohttp session, caching successful responses for `ttl` seconds.
+    Expired entries are revalidated with If-None-Match/If-Modified-Since rather than refetched,
+    and concurrent requests for the same thing share a single request"""
+    def __init__(self, session, loop=None, timeout=10, ttl=60, maxsize=256):
+        self.session = session
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.shared = 0
+        self._cache = OrderedDict()
+        self._inflight = dict()
+
+    @staticmethod
+    def key(url, params=None, headers=None):
+        return (url, tuple(sorted((params or {}).items())), tuple(sorted((headers or {}).items())))
+
+    async def get(self, url, params=None, headers=None, ttl=None):
+        key = self.key(url, params, headers)
+        cached = self._cache.get(key)
+        if cached is not None and cached.expires > monotonic():
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            task = self._inflight[key] = self.loop.create_task(self._fetch(key, url, params, headers, cached, ttl))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, url, params, headers, cached, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        request_headers = dict(headers or {})
+        if cached is not None:
+            if cached.etag:
+                request_headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                request_headers["If-Modified-Since"] = cached.last_modified
+
+        with async_timeout.timeout(self.timeout):
+            async with self.session.get(url, params=params, headers=request_headers) as response:
+                if response.status == 304 and cached is not None:
+                    self.revalidated += 1
+                    cached.expires = monotonic() + ttl
+                    self._store(key, cached)
+                    return cached
+                result = Response(str(response.url), response.status, response.headers, await response.read(),
+                                  monotonic() + ttl)
+
+        if result.status == 200 and ttl > 0:
+            self._store(key, result)
+        else:
+            self._cache.pop(key, None)
+        return result
+
+    def _store(self, key, response):
+        self._cache[key] = response
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, revalidated=self.revalidated, shared=self.shared,
+                    size=len(self._cache))
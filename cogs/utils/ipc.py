@@ -0,0 +1,145 @@
+"""The launcher and its workers talk over a local TCP socket, one JSON object per line.
+The launcher sends requests ({"id", "op", ...}) and a worker answers each with
+{"id", "result"} or {"id", "error"}. Workers also send unprompted notices ({"op"})
+such as "ready" once their shards are up.
+
+Both ends share a random token, which the launcher hands its workers in IPC_TOKEN_ENV.
+Nothing is sent or handled until each side has proven it knows the token:
+the launcher sends {"op": "challenge", "nonce"}, the worker answers with
+{"op": "hello", "cluster", "nonce", "proof"} and the launcher with {"op": "welcome", "proof"}"""
+import hmac
+import asyncio
+import hashlib
+import secrets
+import ujson as json
+from traceback import format_exc
+
+IPC_HOST = "127.0.0.1"
+IPC_PORT = 5001
+IPC_TOKEN_ENV = "TYPHEUS_IPC_TOKEN"
+LINE_LIMIT = 2 ** 24  # Rendered metrics from a big worker can run to a few MB
+HANDSHAKE_TIMEOUT = 10
+
+
+def new_token():
+    return secrets.token_hex(32)
+
+
+def new_nonce():
+    return secrets.token_hex(16)
+
+
+def proof(token, role, nonce):
+    """What `role` ("launcher" or "worker") answers to the other side's nonce.
+    The role is mixed in so one side's answer can never be replayed as the other's"""
+    return hmac.new(token.encode(), "{}:{}".format(role, nonce).encode(), hashlib.sha256).hexdigest()
+
+
+def verify(token, role, nonce, answer):
+    return isinstance(answer, str) and hmac.compare_digest(proof(token, role, nonce), answer)
+
+
+def send(writer, message):
+    writer.write(json.dumps(message).encode() + b"\n")
+
+
+async def receive(reader):
+    """The next message, or None once the other end has gone away"""
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+class IPCClient(object):
+    """A worker's connection to its launcher. Reconnects whenever the launcher goes away,
+    and answers each request with the matching `op_<name>` method, once the launcher has proven it knows `token`"""
+    def __init__(self, bot, cluster, token, host=IPC_HOST, port=IPC_PORT, loop=None, retry=5):
+        if not token:
+            raise ValueError("IPCClient needs the launcher's token, from {}".format(IPC_TOKEN_ENV))
+        self.bot = bot
+        self.cluster = cluster
+        self.token = token
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        self.retry = retry
+        self._writer = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def notify(self, op, **data):
+        if self._writer is not None:
+            send(self._writer, dict(data, op=op))
+
+    async def _handshake(self, reader, writer):
+        challenge = await receive(reader)
+        if challenge is None or challenge.get("op") != "challenge":
+            raise ValueError("Expected a challenge from the launcher")
+        nonce = new_nonce()
+        send(writer, dict(op="hello", cluster=self.cluster, nonce=nonce,
+                          proof=proof(self.token, "worker", challenge.get("nonce"))))
+        welcome = await receive(reader)
+        if welcome is None or welcome.get("op") != "welcome" or \
+           not verify(self.token, "launcher", nonce, welcome.get("proof")):
+            raise ValueError("Launcher failed the handshake")
+
+    async def _run(self):
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=LINE_LIMIT)
+                await asyncio.wait_for(self._handshake(reader, writer), HANDSHAKE_TIMEOUT)
+                self._writer = writer
+                if self.bot.is_ready():
+                    self.notify("ready", cluster=self.cluster)
+                while True:
+                    message = await receive(reader)
+                    if message is None:
+                        break
+                    self.loop.create_task(self._answer(self._writer, message))
+            except (OSError, ValueError, asyncio.TimeoutError):
+                pass
+            self._writer = None
+            if writer is not None:
+                writer.close()
+            await asyncio.sleep(self.retry)
+
+    async def _answer(self, writer, message):
+        handler = getattr(self, "op_" + str(message.get("op")), None)
+        try:
+            if handler is None:
+                raise ValueError("Unknown op {}".format(message.get("op")))
+            reply = dict(id=message.get("id"), result=await handler(**message.get("data", {})))
+        except Exception:
+            reply = dict(id=message.get("id"), error=format_exc())
+        send(writer, reply)
+
+    async def op_metrics(self):
+        return self.bot.metrics.render(cluster=self.cluster)
+
+    async def op_eval(self, body):
+        return await self.bot.cmd.run_cmd(body)
+
+    async def op_shutdown(self):
+        """Log out, the launcher starts this cluster again if it's rolling a restart"""
+        self.bot.running = False
+        self.loop.create_task(self._logout())
+        return True
+
+    async def _logout(self):
+        await asyncio.sleep(0.1)  # Let the reply get out first
+        for shutdown in self.bot.shutdowns:
+            await shutdown()
+        await self.bot.logout()
@@ -0,0 +1,69 @@
+import os
+import gzip
+import atexit
+import shutil
+import logging
+import logging.handlers
+from queue import Queue
+
+# Level for each subsystem's logger, children not listed inherit from their parent
+LEVELS = {"discord": logging.INFO,
+          "discord.gateway": logging.WARNING,
+          "discord.http": logging.WARNING,
+          "typheus": logging.INFO}
+
+_listener = None
+
+
+class SampleFilter(logging.Filter):
+    """Only lets every `rate`th record at or below `level` through, everything above always passes"""
+    def __init__(self, rate, level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        self._seen = 0
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        self._seen += 1
+        return self._seen % self.rate == 0
+
+
+def gzip_namer(name):
+    return name + ".gz"
+
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as log, gzip.open(dest, 'wb') as compressed:
+        shutil.copyfileobj(log, compressed)
+    os.remove(source)
+
+
+def setup_logging(path=os.path.join('resources', 'discord.log'), levels=LEVELS, debug_sample=100,
+                  max_bytes=16_000_000, backups=5):
+    """Route the loggers in `levels` through a queue to a background thread, which writes
+    them to a size rotated log, gzipping old files. Callers only ever pay for a queue put.
+    Calling this again (like the restart loop does) returns the listener that's already running"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+
+    queue = Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(queue)
+    queue_handler.addFilter(SampleFilter(debug_sample))
+    for name, level in levels.items():
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        if "." not in name:  # Children propagate up to these
+            logger.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,357 @@
+import os
+import heapq
+import asyncio
+import hashlib
+import markovify
+import ujson as json
+from operator import itemgetter
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+SNAPSHOT_VERSION = 1
+COMPACT_TO = 0.9  # Fraction of max_states a learned chain is pruned back to
+
+CORPORA = dict(dave="resources/dave.txt",
+               alterniabound="resources/alterniabound_transcript.txt")
+
+# Each voice is a weighted mix of corpora
+VOICES = dict(dave=dict(dave=1),
+              alterniabound=dict(alterniabound=1),
+              mixed=dict(dave=2, alterniabound=1))
+DEFAULT_VOICE = "dave"
+LEARNED_VOICE = "learned"  # The guild's own chain, learned from its opted in channels
+
+
+def snapshot_path(corpus):
+    return os.path.splitext(corpus)[0] + ".markov.json"
+
+
+def load_model(corpus, snapshot=None):
+    """Load the markov model for a newline separated corpus.
+    The compiled chain is kept in a snapshot file next to the corpus and is
+    only rebuilt from the text when the corpus' hash (or SNAPSHOT_VERSION) changes.
+    This blocks, run it in an executor"""
+    snapshot = snapshot or snapshot_path(corpus)
+    with open(corpus, "rb") as tsf:
+        data = tsf.read()
+    digest = hashlib.sha1(data).hexdigest()
+
+    try:
+        with open(snapshot, encoding="utf-8") as snf:
+            saved = json.load(snf)
+        if saved["version"] == SNAPSHOT_VERSION and saved["hash"] == digest:
+            return markovify.NewlineText.from_dict(saved["model"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    model = markovify.NewlineText(data.decode("utf-8", 'replace'))
+    tmp = snapshot + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as snf:
+        json.dump(dict(version=SNAPSHOT_VERSION, hash=digest, model=model.to_dict()), snf)
+    os.replace(tmp, snapshot)
+    return model
+
+
+class SentenceBuffer(object):
+    """Keeps up to `size` sentences from `model` ready to send.
+    Sentences are generated on `executor` in batches, at most one batch at a time,
+    and a new batch is started whenever the buffer drops below half full"""
+    def __init__(self, model, executor, loop=None, size=32, tries=100):
+        self.model = model
+        self.executor = executor
+        self.loop = loop or asyncio.get_event_loop()
+        self.size = size
+        self.tries = tries
+        self.sentences = deque(maxlen=size)
+        self._refilling = None
+
+    def _generate(self, count):
+        sentences = (self.model.make_sentence(tries=self.tries) for _ in range(count))
+        return [sentence for sentence in sentences if sentence]
+
+    async def _fill(self):
+        try:
+            count = self.size - len(self.sentences)
+            self.sentences.extend(await self.loop.run_in_executor(self.executor, self._generate, count))
+        finally:
+            self._refilling = None
+
+    def refill(self):
+        if self._refilling is None:
+            self._refilling = self.loop.create_task(self._fill())
+        return self._refilling
+
+    async def get(self):
+        """Get a sentence, only waiting on the executor if the buffer ran dry. May return None"""
+        if not self.sentences:
+            await asyncio.shield(self.refill())
+        sentence = self.sentences.popleft() if self.sentences else None
+        if len(self.sentences) < self.size // 2:
+            self.refill()
+        return sentence
+
+
+class MarkovEngine(object):
+    """Serves sentences for every voice in `voices`, loading each one on first use.
+    Loaded voices are kept in an LRU that evicts the least recently used ones once
+    their chains hold more than `max_states` states between them, learned chains
+    are kept the same way under `max_learned_states`"""
+    def __init__(self, corpora=CORPORA, voices=VOICES, loop=None, workers=2, max_states=500_000,
+                 learned_dir="resources/learned", maintain_every=600, max_learned_states=500_000):
+        self.corpora = corpora
+        self.voices = voices
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_states = max_states
+        self._buffers = OrderedDict()
+        self._states = dict()
+        self._lock = asyncio.Lock()
+
+        # Learned chains are only ever touched from this one thread, so generating
+        # from them never races with the messages they're learning from
+        self.learned_dir = learned_dir
+        self.learned = OrderedDict()
+        self.max_learned_states = max_learned_states
+        self.learn_executor = ThreadPoolExecutor(max_workers=1)
+        self.maintain_every = maintain_every
+        self._learned_buffers = dict()
+        self._maintenance = None
+
+    def _build(self, voice):
+        weights = self.voices[voice]
+        models = [load_model(self.corpora[corpus]) for corpus in weights]
+        if len(models) == 1:
+            return models[0]
+        return markovify.combine(models, list(weights.values()))
+
+    def _evict(self):
+        while len(self._buffers) > 1 and sum(self._states.values()) > self.max_states:
+            voice, _ = self._buffers.popitem(last=False)
+            del self._states[voice]
+
+    async def get_buffer(self, voice):
+        buffer = self._buffers.get(voice)
+        if buffer is None:
+            async with self._lock:
+                buffer = self._buffers.get(voice)
+                if buffer is None:
+                    model = await self.loop.run_in_executor(self.executor, self._build, voice)
+                    buffer = self._buffers[voice] = SentenceBuffer(model, self.executor, loop=self.loop)
+                    self._states[voice] = len(model.chain.model)
+                    self._evict()
+        self._buffers.move_to_end(voice)
+        return buffer
+
+    def get_learned(self, guild_id):
+        model = self.learned.get(guild_id)
+        if model is None:
+            path = os.path.join(self.learned_dir, "{}.json".format(guild_id))
+            model = self.learned[guild_id] = LearnedModel(path)
+            self._learned_buffers[guild_id] = SentenceBuffer(model, self.learn_executor, loop=self.loop)
+            if self._maintenance is None:
+                self._maintenance = self.loop.create_task(self.maintain())
+            self._evict_learned()
+        else:
+            self.learned.move_to_end(guild_id)
+        return model
+
+    def _evict_learned(self):
+        """A chain's size is only known once it has loaded, so a new one never pushes anything out until then.
+        Evicted chains are saved on learn_executor, ahead of anything that would load them again"""
+        while len(self.learned) > 1 and sum(model.states for model in self.learned.values()) > self.max_learned_states:
+            guild_id, model = self.learned.popitem(last=False)
+            del self._learned_buffers[guild_id]
+            self.loop.run_in_executor(self.learn_executor, model.maintain)
+
+    def learn(self, guild_id, text):
+        self.get_learned(guild_id).learn(text)
+
+    async def maintain(self):
+        """Periodically fold in pending messages, compact and snapshot every learned chain"""
+        while True:
+            await asyncio.sleep(self.maintain_every)
+            await self.flush()
+            self._evict_learned()
+
+    async def flush(self):
+        """Fold in, compact and save every learned chain now, so shutting down loses nothing"""
+        for model in list(self.learned.values()):
+            await self.loop.run_in_executor(self.learn_executor, model.maintain)
+
+    async def sentence(self, voice=DEFAULT_VOICE, guild_id=None):
+        if voice == LEARNED_VOICE:
+            if guild_id is None:
+                return None
+            self.get_learned(guild_id)
+            return await self._learned_buffers[guild_id].get()
+        return await (await self.get_buffer(voice)).get()
+
+    def stats(self):
+        return dict(loaded=list(self._buffers), states=sum(self._states.values()),
+                    learned=len(self.learned), learned_states=sum(model.states for model in self.learned.values()))
+
+
+def prune(model, state_size, max_states):
+    """Drop the least seen states from a chain's model dict in place until at most `max_states`
+    are left, along with any transitions left leading to states that no longer exist"""
+    begin = tuple([markovify.chain.BEGIN] * state_size)
+    excess = len(model) - max_states
+    if excess > 0:
+        weights = ((sum(follows.values()), state) for state, follows in model.items() if state != begin)
+        for _, state in heapq.nsmallest(excess, weights, key=itemgetter(0)):
+            del model[state]
+
+    changed = True
+    while changed:
+        changed = False
+        for state in list(model):
+            follows = model[state]
+            for word in list(follows):
+                if word != markovify.chain.END and state[1:] + (word,) not in model:
+                    del follows[word]
+                    changed = True
+            if not follows:
+                del model[state]
+                changed = True
+
+
+class LearnedModel(object):
+    """A chain for one guild that grows as messages arrive, without being rebuilt.
+    learn() only queues text, everything else must run on the engine's learn_executor"""
+    def __init__(self, path, state_size=2, max_states=50_000, max_pending=5000):
+        self.path = path
+        self.state_size = state_size
+        self.max_states = max_states
+        self.pending = deque(maxlen=max_pending)
+        self.text = None
+        self.states = 0
+        self._loaded = False
+        self._dirty = False
+
+    def learn(self, text):
+        self.pending.append(text)
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self.path, encoding="utf-8") as snf:
+                self.text = markovify.NewlineText.from_dict(json.load(snf))
+            self.states = len(self.text.chain.model)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def apply(self):
+        """Append the transitions for every queued message to the chain"""
+        if not self._loaded:
+            self._load()
+        begin = tuple([markovify.chain.BEGIN] * self.state_size)
+        while self.pending:
+            for line in self.pending.popleft().splitlines():
+                if self.text is None:
+                    try:
+                        self.text = markovify.NewlineText(line, state_size=self.state_size, retain_original=False)
+                    except KeyError:  # Nothing usable in the line, so no begin state to build from
+                        pass
+                    continue
+                if not self.text.test_sentence_input(line):
+                    continue
+                words = self.text.word_split(line)
+                if not words:
+                    continue
+                items = list(begin) + words + [markovify.chain.END]
+                model = self.text.chain.model
+                for i in range(len(words) + 1):
+                    follows = model.setdefault(tuple(items[i:i + self.state_size]), dict())
+                    follows[items[i + self.state_size]] = follows.get(items[i + self.state_size], 0) + 1
+                self._dirty = True
+
+        if self.text is not None:
+            if begin in self.text.chain.model:
+                self.text.chain.precompute_begin_state()
+            self.states = len(self.text.chain.model)
+
+    def compact(self):
+        """Once the chain grows past max_states, prune its least seen states until it's
+        back to COMPACT_TO of the cap, so it isn't pruned again on every maintenance pass"""
+        if self.text is not None and len(self.text.chain.model) > self.max_states:
+            prune(self.text.chain.model, self.state_size, int(self.max_states * COMPACT_TO))
+            if tuple([markovify.chain.BEGIN] * self.state_size) not in self.text.chain.model:
+                self.text = None
+            else:
+                self.text.chain.precompute_begin_state()
+            self._dirty = True
+        self.states = len(self.text.chain.model) if self.text is not None else 0
+
+    def save(self):
+        if not self._dirty or self.text is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as snf:
+            json.dump(self.text.to_dict(), snf)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def maintain(self):
+        self.apply()
+        self.compact()
+        self.save()
+
+    def make_sentence(self, **kwargs):
+        self.apply()
+        if self.text is None:
+            return None
+        return self.text.make_sentence(**kwargs)
+
+
+class MarkovSettings(object):
+    """Each guild's voice and the channels learned from. Changes are written straight to
+    the database, one row at a time, so clusters never overwrite each other's settings.
+    Reads come from memory, a guild only ever lives on the one cluster that changes it"""
+    def __init__(self):
+        self.db = None
+        self.voices = dict()  # Guild id -> voice
+        self.learning = dict()  # Channel id -> guild id
+
+    async def load(self, db, legacy=("resources/markov.json", "resources/markov_learning.json")):
+        """Read everything from the database, importing the old JSON files the first time"""
+        self.db = db
+        voices = await db.fetch("get_markov_voices")
+        learning = await db.fetch("get_markov_learning")
+        if not voices and not learning:
+            voices, learning = self._read_legacy(*legacy)
+            await db.executemany("set_markov_voice", voices)
+            await db.executemany("add_markov_learning", learning)
+        self.voices = {guild: voice for guild, voice in voices}
+        self.learning = {channel: guild for channel, guild in learning}
+
+    @staticmethod
+    def _read_legacy(voices_path, learning_path):
+        found = []
+        for path in (voices_path, learning_path):
+            try:
+                with open(path, encoding="utf-8") as fp:
+                    found.append(json.load(fp))
+            except (OSError, ValueError):
+                found.append(dict())
+        voices, learning = found
+        return ([(int(guild), voice) for guild, voice in voices.items()],
+                [(int(channel), int(guild)) for channel, guild in learning.items()])
+
+    def voice(self, guild_id):
+        return self.voices.get(guild_id, DEFAULT_VOICE)
+
+    def is_learning(self, channel_id):
+        return channel_id in self.learning
+
+    async def set_voice(self, guild_id, voice):
+        await self.db.execute("set_markov_voice", guild_id, voice)
+        self.voices[guild_id] = voice
+
+    async def set_learning(self, channel_id, guild_id, learning):
+        if learning:
+            await self.db.execute("add_markov_learning", channel_id, guild_id)
+            self.learning[channel_id] = guild_id
+        else:
+            await self.db.execute("remove_markov_learning", channel_id)
+            self.learning.pop(channel_id, None)
@@ -0,0 +1,168 @@
+from collections import defaultdict, Counter, deque, OrderedDict
+from bisect import bisect_left
+from time import monotonic
+
+# Upper bounds in seconds, the last bucket catches everything else
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Histogram(object):
+    """Fixed bucket latency histogram, observing a value is a bisect and three increments"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate the q quantile by interpolating within the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-2]
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield "{}_bucket{} {}".format(name, format_labels(labels, le=le), cumulative)
+        yield "{}_sum{} {}".format(name, format_labels(labels), self.sum)
+        yield "{}_count{} {}".format(name, format_labels(labels), self.count)
+
+
+class EventCounter(object):
+    """Counts events by name, for the whole uptime and per minute over the last `window` minutes.
+    record() is cheap enough to call for every gateway frame"""
+    def __init__(self, window=60):
+        self.total = Counter()
+        self.minutes = deque(maxlen=window)
+        self._minute = None
+        self._current = None
+
+    def record(self, event):
+        self.total[event] += 1
+        minute = int(monotonic() // 60)
+        if minute != self._minute:
+            self._minute = minute
+            self._current = Counter()
+            self.minutes.append((minute, self._current))
+        self._current[event] += 1
+
+    def recent(self, minutes=60):
+        """Counts over the last `minutes` minutes, including the current one"""
+        since = int(monotonic() // 60) - minutes
+        counts = Counter()
+        for minute, counter in self.minutes:
+            if minute > since:
+                counts.update(counter)
+        return counts
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in zip(labels, escaped)) + "}"
+
+
+class Metrics(object):
+    """Command and database timings, plus any gauges registered by other parts of the bot.
+    render() gives the Prometheus text exposition format"""
+    def __init__(self):
+        self.commands = defaultdict(Histogram)
+        self.command_errors = Counter()
+        self.queries = defaultdict(Histogram)
+        self.query_errors = Counter()
+        self.collectors = dict()
+
+    def observe_command(self, name, seconds):
+        self.commands[name].observe(seconds)
+
+    def command_error(self, name, error):
+        self.command_errors[(name, type(error).__name__)] += 1
+
+    def observe_query(self, name, seconds):
+        self.queries[name].observe(seconds)
+
+    def query_error(self, name, error):
+        self.query_errors[(name, type(error).__name__)] += 1
+
+    def register(self, name, kind, help, collect):
+        """Add a metric whose values come from `collect()` at render time.
+        collect returns either a number or a dict mapping label dicts (as tuples of pairs) to numbers"""
+        self.collectors[name] = (kind, help, collect)
+
+    def render(self, **labels):
+        """Render everything, adding `labels` to every sample"""
+        lines = []
+        lines.append("# HELP typheus_command_seconds Time from command invocation to completion")
+        lines.append("# TYPE typheus_command_seconds histogram")
+        for name, histogram in self.commands.items():
+            lines.extend(histogram.lines("typheus_command_seconds", dict(labels, command=name)))
+
+        lines.append("# HELP typheus_command_errors_total Commands that raised, by error type")
+        lines.append("# TYPE typheus_command_errors_total counter")
+        for (name, error), count in self.command_errors.items():
+            lines.append("typheus_command_errors_total{} {}".format(format_labels(labels, command=name, error=error), count))
+
+        lines.append("# HELP typheus_query_seconds Time taken by each named database statement")
+        lines.append("# TYPE typheus_query_seconds histogram")
+        for name, histogram in self.queries.items():
+            lines.extend(histogram.lines("typheus_query_seconds", dict(labels, query=name)))
+
+        lines.append("# HELP typheus_query_errors_total Database statements that raised, by error type")
+        lines.append("# TYPE typheus_query_errors_total counter")
+        for (name, error), count in self.query_errors.items():
+            lines.append("typheus_query_errors_total{} {}".format(format_labels(labels, query=name, error=error), count))
+
+        for name, (kind, help, collect) in self.collectors.items():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            values = collect()
+            if isinstance(values, dict):
+                for sample_labels, value in values.items():
+                    lines.append("{}{} {}".format(name, format_labels(dict(labels, **dict(sample_labels))), value))
+            else:
+                lines.append("{}{} {}".format(name, format_labels(labels), values))
+
+        return "\n".join(lines) + "\n"
+
+
+def merge(texts):
+    """Combine several render() outputs into one, keeping each metric's samples together
+    under a single HELP/TYPE header however many of the texts they came from"""
+    families = OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                family = families.setdefault(name, dict(header=[], samples=[]))
+                if len(family["header"]) < 2 and line not in family["header"]:
+                    family["header"].append(line)
+            elif line and family is not None:
+                family["samples"].append(line)
+
+    lines = []
+    for family in families.values():
+        lines.extend(family["header"])
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,148 @@
+import io
+import os
+import mmap
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+
+class MappedFile(io.RawIOBase):
+    """A read only file object over an mmap, for APIs that want a real file rather than a buffer.
+    Reads copy straight out of the mapping, closing it closes the mapping too"""
+    def __init__(self, mapped):
+        super().__init__()
+        self._mapped = mapped
+        self._view = memoryview(mapped)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self._view[self._pos:self._pos + len(buffer)] as data:
+            count = len(data)
+            buffer[:count] = data
+        self._pos += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            self._mapped.close()
+        super().close()
+
+
+class RenderCache(object):
+    """Rendered images on disk, named by the sha256 of whatever produced them and
+    sharded into directories by the first two hex digits. Once the files add up to more
+    than `max_bytes` the least recently used are deleted. Hits are memory mapped rather than read.
+    The index is only touched from the event loop, file writes, deletes and the startup scan run in the executor"""
+    def __init__(self, root, max_bytes=256_000_000, suffix=".png", loop=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.loop = loop or asyncio.get_event_loop()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._index = OrderedDict()  # Digest -> file size, least recently used first
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + self.suffix)
+
+    def _scan(self):
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(self.suffix):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name[:-len(self.suffix)], stat.st_size))
+        return [(digest, size) for _, digest, size in sorted(found)]
+
+    async def load(self):
+        """Index what's already on disk, older than anything cached since startup"""
+        found = await self.loop.run_in_executor(None, self._scan)
+        index = OrderedDict((digest, size) for digest, size in found if digest not in self._index)
+        index.update(self._index)
+        self._index = index
+        self.size = sum(index.values())
+        await self._evict()
+
+    def get(self, digest):
+        """A MappedFile of the cached image, or None. The caller closes it"""
+        if digest not in self._index:
+            self.misses += 1
+            return None
+        path = self.path(digest)
+        try:
+            with open(path, "rb") as fp:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)  # So the order survives a restart
+        except (OSError, ValueError):
+            self._forget(digest)
+            self.misses += 1
+            return None
+        self._index.move_to_end(digest)
+        self.hits += 1
+        return MappedFile(mapped)
+
+    def _write(self, digest, data):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+
+    def _remove(self, digests):
+        for digest in digests:
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+    async def put(self, digest, data):
+        """Store `data`, evicting old entries to stay under max_bytes"""
+        if not data or len(data) > self.max_bytes:
+            return
+        await self.loop.run_in_executor(None, self._write, digest, data)
+        self._forget(digest)
+        self._index[digest] = len(data)
+        self.size += len(data)
+        await self._evict()
+
+    async def _evict(self):
+        evicted = []
+        while self.size > self.max_bytes:
+            digest = next(iter(self._index))
+            self._forget(digest)
+            evicted.append(digest)
+        if evicted:
+            await self.loop.run_in_executor(None, self._remove, evicted)
+
+    def _forget(self, digest):
+        self.size -= self._index.pop(digest, 0)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, files=len(self._index), bytes=self.size)
@@ -0,0 +1,47 @@
+from random import random, randrange
+
+
+class AliasTable(object):
+    """Weighted random choice using Walker's alias method.
+    Building the table is O(n) in the number of items, each draw is O(1)
+    however large the weights are. to_dict/from_dict let the table be stored as JSON"""
+    def __init__(self, items, probs, aliases):
+        self.items = items
+        self.probs = probs
+        self.aliases = aliases
+
+    @classmethod
+    def from_weights(cls, weights):
+        items = [item for item, weight in weights.items() if weight > 0]
+        if not items:
+            raise ValueError("At least one item must have a positive weight")
+        total = sum(weights[item] for item in items)
+        n = len(items)
+        scaled = [weights[item] * n / total for item in items]
+        probs = [1.0] * n
+        aliases = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probs[less] = scaled[less]
+            aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+        return cls(items, probs, aliases)
+
+    def draw(self):
+        i = randrange(len(self.items))
+        return self.items[i] if random() < self.probs[i] else self.items[self.aliases[i]]
+
+    def to_dict(self):
+        return dict(items=self.items, probs=self.probs, aliases=self.aliases)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["items"], data["probs"], data["aliases"])
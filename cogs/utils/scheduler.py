@@ -0,0 +1,57 @@
+from traceback import print_exc
+import datetime
+import asyncio
+import heapq
+
+
+class DeadlineScheduler(object):
+    """Calls `await callback(key)` once each scheduled (utc) deadline passes.
+    A single task sleeps until the earliest deadline in a heap, however many keys are waiting"""
+    def __init__(self, callback, loop=None):
+        self.callback = callback
+        self.loop = loop or asyncio.get_event_loop()
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, when, key):
+        heapq.heappush(self._heap, (when, key))
+        if self._heap[0] == (when, key):
+            self._wakeup.set()  # New earliest deadline, go back to sleep for less time
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def clear(self):
+        self._heap.clear()
+        self._wakeup.set()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            when, key = self._heap[0]
+            delay = (when - datetime.datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            heapq.heappop(self._heap)
+            try:
+                await self.callback(key)
+            except:
+                print_exc()
@@ -0,0 +1,118 @@
+import discord
+
+
+class PopulationStats(object):
+    """Member and channel totals across every guild, kept up to date from gateway events
+    so reading them never has to walk the member cache. on_ready recounts from scratch,
+    which also corrects any drift from events missed while disconnected"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.guilds = set()
+        self.members = 0
+        self.online = 0
+        self.user_guilds = dict()  # User id -> set of ids of the counted guilds they're in
+        self.text_channels = 0
+        self.voice_channels = 0
+
+        for event in ("on_ready", "on_guild_join", "on_guild_available", "on_guild_remove",
+                      "on_member_join", "on_member_remove", "on_member_update",
+                      "on_guild_channel_create", "on_guild_channel_delete"):
+            bot.add_listener(getattr(self, event), event)
+
+        bot.metrics.register("typheus_members", "gauge", "Guild memberships, and how many of them are online",
+                             lambda: {(("status", "total"),): self.members, (("status", "online"),): self.online})
+        bot.metrics.register("typheus_unique_users", "gauge", "Distinct users across every guild",
+                             lambda: self.unique)
+        bot.metrics.register("typheus_channels", "gauge", "Guild channels, by type",
+                             lambda: {(("type", "text"),): self.text_channels, (("type", "voice"),): self.voice_channels})
+
+    @property
+    def unique(self):
+        return len(self.user_guilds)
+
+    def shared_guilds(self, user_id):
+        """Ids of every guild the bot shares with this user. Don't modify the set"""
+        return self.user_guilds.get(user_id, frozenset())
+
+    def recount(self):
+        self.guilds.clear()
+        self.members = self.online = self.text_channels = self.voice_channels = 0
+        self.user_guilds.clear()
+        for guild in self.bot.guilds:
+            self.add_guild(guild)
+
+    def add_guild(self, guild):
+        if guild.id in self.guilds:
+            return
+        self.guilds.add(guild.id)
+        for member in guild.members:
+            self._add_member(member)
+        for channel in guild.channels:
+            self._count_channel(channel, 1)
+
+    def remove_guild(self, guild):
+        if guild.id not in self.guilds:
+            return
+        self.guilds.discard(guild.id)
+        for member in guild.members:
+            self._remove_member(member)
+        for channel in guild.channels:
+            self._count_channel(channel, -1)
+
+    def _add_member(self, member):
+        self.members += 1
+        if member.status != discord.Status.offline:
+            self.online += 1
+        self.user_guilds.setdefault(member.id, set()).add(member.guild.id)
+
+    def _remove_member(self, member):
+        self.members -= 1
+        if member.status != discord.Status.offline:
+            self.online -= 1
+        guilds = self.user_guilds.get(member.id)
+        if guilds is not None:
+            guilds.discard(member.guild.id)
+            if not guilds:
+                del self.user_guilds[member.id]
+
+    def _count_channel(self, channel, delta):
+        if isinstance(channel, discord.TextChannel):
+            self.text_channels += delta
+        elif isinstance(channel, discord.VoiceChannel):
+            self.voice_channels += delta
+
+    async def on_ready(self):
+        self.recount()
+
+    async def on_guild_join(self, guild):
+        self.add_guild(guild)
+
+    async def on_guild_available(self, guild):
+        self.add_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.remove_guild(guild)
+
+    async def on_member_join(self, member):
+        if member.guild.id in self.guilds:
+            self._add_member(member)
+
+    async def on_member_remove(self, member):
+        if member.guild.id in self.guilds:
+            self._remove_member(member)
+
+    async def on_member_update(self, before, after):
+        if after.guild.id not in self.guilds:
+            return
+        was_online = before.status != discord.Status.offline
+        is_online = after.status != discord.Status.offline
+        if was_online != is_online:
+            self.online += 1 if is_online else -1
+
+    async def on_guild_channel_create(self, channel):
+        if channel.guild.id in self.guilds:
+            self._count_channel(channel, 1)
+
+    async def on_guild_channel_delete(self, channel):
+        if channel.guild.id in self.guilds:
+            self._count_channel(channel, -1)
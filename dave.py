@@ -18,16 +18,153 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
-"""get all of daves dialog"""
-import urllib.request
+"""get all of daves dialog
+
+Fetches MS Paint Adventures pages concurrently, keeping every page in an
+on-disk cache and a checkpoint of what has been written, so an interrupted
+run resumes where it left off. Use --offline DIR to read saved pages instead
+of the network, and --character to pull out someone other than Dave."""
+import os
 import re
+import asyncio
+import aiohttp
+import async_timeout
+import argparse
+import ujson as json
+
+URL = 'http://www.mspaintadventures.com/?s=6&p={}'
+
+# Text color and chat handle for each character's pesterlog lines
+CHARACTERS = dict(dave=("#e00707", "TG"),
+                  john=("#0715cd", "EB"),
+                  rose=("#b536da", "TT"),
+                  jade=("#4ac925", "GG"),
+                  karkat=("#626262", "CG"))
+
+
+def handle_extractor(color, handle):
+    """Build an extractor returning every line `handle` says in `color` on a page"""
+    pattern = re.compile(r'<span style="color: {}">{}: (.*?)</span>'.format(re.escape(color), re.escape(handle)))
+    return pattern.findall
+
+
+def page_name(page):
+    return "{}.html".format(str(page).zfill(6))
+
+
+class Scraper(object):
+    def __init__(self, extract, output, cache_dir=None, offline=None, concurrency=8, retries=3):
+        self.extract = extract
+        self.output = output
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.concurrency = concurrency
+        self.retries = retries
+        self.checkpoint = output + ".checkpoint"
+        self.session = None
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as page:
+                return page.read().decode("utf-8", "replace")
+        except FileNotFoundError:
+            return None
+
+    def _cache(self, page, html):
+        path = os.path.join(self.cache_dir, page_name(page))
+        with open(path + ".tmp", 'wb') as cache:
+            cache.write(html.encode("utf-8"))
+        os.replace(path + ".tmp", path)
+
+    async def fetch(self, page, semaphore):
+        """Get a page's html from the offline directory, the cache or the site, None if it doesn't exist"""
+        if self.offline:
+            return self._read(os.path.join(self.offline, page_name(page)))
+        if self.cache_dir:
+            html = self._read(os.path.join(self.cache_dir, page_name(page)))
+            if html is not None:
+                return html
+
+        async with semaphore:
+            for attempt in range(self.retries):
+                try:
+                    with async_timeout.timeout(60):
+                        async with self.session.get(URL.format(str(page).zfill(6))) as response:
+                            if response.status == 404:
+                                return None
+                            response.raise_for_status()
+                            html = await response.text(errors="replace")
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt == self.retries - 1:
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+
+        if self.cache_dir:
+            self._cache(page, html)
+        return html
+
+    def resume(self, start):
+        """Where to start from and where to truncate the output to, from the checkpoint"""
+        try:
+            with open(self.checkpoint) as cpf:
+                saved = json.load(cpf)
+            return saved["next"], saved["offset"]
+        except (OSError, ValueError, KeyError):
+            return start, 0
+
+    def save_checkpoint(self, page, offset):
+        with open(self.checkpoint + ".tmp", 'w') as cpf:
+            json.dump(dict(next=page, offset=offset), cpf)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+
+    async def run(self, start, end):
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        page, offset = self.resume(start)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        if not self.offline:
+            self.session = aiohttp.ClientSession()
+
+        try:
+            with open(self.output, 'a+', encoding="utf-8") as out:
+                out.truncate(offset)
+                out.seek(offset)
+                # Fetch a window of pages at a time, then write them out in order
+                window = self.concurrency * 4
+                while page < end:
+                    pages = range(page, min(page + window, end))
+                    results = await asyncio.gather(*(self.fetch(p, semaphore) for p in pages))
+                    for p, html in zip(pages, results):
+                        found = self.extract(html) if html is not None else []
+                        print(p, len(found), "found")
+                        for line in found:
+                            out.write(line + "\n")
+                    out.flush()
+                    page = pages[-1] + 1
+                    self.save_checkpoint(page, out.tell())
+        finally:
+            if self.session is not None:
+                await self.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--character", default="dave", choices=sorted(CHARACTERS))
+    parser.add_argument("--output", default="dave.txt")
+    parser.add_argument("--start", type=int, default=1939)
+    parser.add_argument("--end", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--cache", default="pages", help="Directory to keep fetched pages in")
+    parser.add_argument("--offline", metavar="DIR", help="Read saved pages (000123.html) from DIR instead of fetching")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over")
+    args = parser.parse_args()
 
-with open("dave.txt", 'w+') as e:
-    for i in range(1939, 10000):
-        with urllib.request.urlopen('http://www.mspaintadventures.com/?s=6&p={}'.format(str(i).zfill(6))) as response:
-           html = response.read()
+    scraper = Scraper(handle_extractor(*CHARACTERS[args.character]), args.output,
+                      cache_dir=args.cache, offline=args.offline, concurrency=args.concurrency)
+    if args.restart and os.path.exists(scraper.checkpoint):
+        os.remove(scraper.checkpoint)
+    asyncio.get_event_loop().run_until_complete(scraper.run(args.start, args.end))
 
-        a = re.findall(r'<span style="color: #e00707">TG: (.*)</span>', html.decode())
-        print(i, len(a), "found")
-        b = "\n".join(a)
-        e.write(b)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2017, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+"""Runs Typheus as a cluster of worker processes, each owning a contiguous range of shards.
+Crashed workers are started again with exponential backoff, SIGHUP (or /restart on the
+web server) restarts them one at a time, and the web server runs here, once, asking
+the workers for anything it can't answer itself over a local IPC socket.
+
+    python3 launcher.py --clusters 4 [--shard-count 16] [Typheus.py arguments...]
+"""
+import os
+import sys
+import signal
+import asyncio
+import aiohttp
+import asyncpg
+import argparse
+import ujson as json
+from time import monotonic
+from itertools import count
+
+from cogs.utils.db import CONNECTION
+from cogs.utils.ipc import IPC_HOST, IPC_PORT, IPC_TOKEN_ENV, LINE_LIMIT, HANDSHAKE_TIMEOUT, \
+    send, receive, new_token, new_nonce, proof, verify
+from cogs.utils.metrics import Metrics
+from WebServer import ClusterRunner
+
+BACKOFF_MIN = 5
+BACKOFF_MAX = 300
+STABLE_AFTER = 120  # A worker that stays up this long has its backoff reset
+IDENTIFY_DELAY = 5.5  # Discord allows one identify every 5 seconds
+READY_TIMEOUT = 600
+REQUEST_TIMEOUT = 30
+
+
+def shard_ranges(shard_count, clusters):
+    """Split the shards into `clusters` contiguous, nearly equal ranges"""
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster in range(clusters):
+        end = start + size + (cluster < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def recommended_shards(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discordapp.com/api/v6/gateway/bot",
+                               headers={"Authorization": "Bot " + token}) as response:
+            return (await response.json())["shards"]
+
+
+class Worker(object):
+    def __init__(self, cluster, shard_ids, shard_count):
+        self.cluster = cluster
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.writer = None
+        self.ready = asyncio.Event()
+        self.restarting = False
+        self.exited = False
+        self.restarts = 0
+        self.pending = dict()
+
+    @property
+    def shards(self):
+        return "{}-{}".format(self.shard_ids[0], self.shard_ids[-1])
+
+
+class Launcher(object):
+    def __init__(self, clusters, shard_count, args=(), loop=None, ipc_port=IPC_PORT):
+        self.loop = loop or asyncio.get_event_loop()
+        self.ipc_port = ipc_port
+        self.token = new_token()  # Workers get it in their environment, where other users can't read it
+        self.args = list(args)
+        self.workers = [Worker(cluster, shard_ids, shard_count)
+                        for cluster, shard_ids in enumerate(shard_ranges(shard_count, clusters))]
+        self.running = True
+        self.metrics = Metrics()
+        self.metrics.register("typheus_cluster_up", "gauge", "Whether each cluster's worker is connected and ready",
+                              lambda: {(("cluster", w.cluster),): int(w.ready.is_set()) for w in self.workers})
+        self.metrics.register("typheus_cluster_restarts_total", "counter", "Times each cluster's worker was started again",
+                              lambda: {(("cluster", w.cluster),): w.restarts for w in self.workers})
+        self._ids = count()
+        self._restart_lock = asyncio.Lock()
+
+    async def start(self):
+        await asyncio.start_server(self.on_connection, IPC_HOST, self.ipc_port, limit=LINE_LIMIT)
+        for worker in self.workers:
+            self.loop.create_task(self.supervise(worker))
+            await asyncio.sleep(IDENTIFY_DELAY * len(worker.shard_ids))
+
+    async def supervise(self, worker):
+        backoff = BACKOFF_MIN
+        while self.running:
+            started = monotonic()
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable, "Typheus.py", "--shards", worker.shards, "--shard-count", str(worker.shard_count),
+                "--cluster", str(worker.cluster), "--clusters", str(len(self.workers)),
+                "--ipc-port", str(self.ipc_port), *self.args,
+                env=dict(os.environ, **{IPC_TOKEN_ENV: self.token}))
+            code = await worker.process.wait()
+            worker.ready.clear()
+
+            if worker.restarting:
+                worker.restarting = False
+            elif code == 0:  # Logged out on purpose
+                print("Cluster {} exited".format(worker.cluster))
+                worker.exited = True
+                if all(w.exited for w in self.workers):
+                    self.loop.stop()
+                return
+            else:
+                backoff = BACKOFF_MIN if monotonic() - started > STABLE_AFTER else min(backoff * 2, BACKOFF_MAX)
+                print("Cluster {} exited with {}, restarting in {}s".format(worker.cluster, code, backoff))
+                await asyncio.sleep(backoff)
+            worker.restarts += 1
+
+    async def on_connection(self, reader, writer):
+        worker = None
+        try:
+            nonce = new_nonce()
+            send(writer, dict(op="challenge", nonce=nonce))
+            hello = await asyncio.wait_for(receive(reader), HANDSHAKE_TIMEOUT)
+            if hello is None or hello.get("op") != "hello" or not verify(self.token, "worker", nonce, hello.get("proof")):
+                return
+            worker = self.workers[hello["cluster"]]
+            worker.writer = writer
+            send(writer, dict(op="welcome", proof=proof(self.token, "launcher", hello.get("nonce"))))
+
+            while True:
+                message = await receive(reader)
+                if message is None:
+                    break
+                if message.get("op") == "ready":
+                    worker.ready.set()
+                elif message.get("id") in worker.pending:
+                    future = worker.pending.pop(message["id"])
+                    if not future.done():
+                        future.set_result(message)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        finally:
+            if worker is not None and worker.writer is writer:
+                worker.writer = None
+                worker.ready.clear()
+                for future in worker.pending.values():
+                    future.cancel()
+                worker.pending.clear()
+            writer.close()
+
+    async def request(self, worker, op, **data):
+        """Ask one worker to run `op`, raising if it's not connected, fails or takes too long"""
+        if worker.writer is None:
+            raise ConnectionError("Cluster {} is not connected".format(worker.cluster))
+        id = next(self._ids)
+        future = worker.pending[id] = self.loop.create_future()
+        send(worker.writer, dict(id=id, op=op, data=data))
+        try:
+            reply = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        finally:
+            worker.pending.pop(id, None)
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply["result"]
+
+    async def broadcast(self, op, **data):
+        """Run `op` on every worker at once, mapping each cluster to its result or the error it gave"""
+        results = await asyncio.gather(*(self.request(worker, op, **data) for worker in self.workers),
+                                       return_exceptions=True)
+        return {worker.cluster: result if not isinstance(result, BaseException) else "\n{!r}\n".format(result)
+                for worker, result in zip(self.workers, results)}
+
+    async def restart(self, worker):
+        """Restart one worker and wait for its shards to come back up"""
+        worker.restarting = True
+        try:
+            await self.request(worker, "shutdown")
+            await asyncio.wait_for(worker.process.wait(), REQUEST_TIMEOUT)
+        except (ConnectionError, RuntimeError, asyncio.TimeoutError, asyncio.CancelledError):
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.terminate()
+        try:
+            await asyncio.wait_for(worker.ready.wait(), READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Cluster {} didn't come back up within {}s, moving on".format(worker.cluster, READY_TIMEOUT))
+
+    async def rolling_restart(self):
+        if self._restart_lock.locked():
+            return
+        async with self._restart_lock:
+            for worker in self.workers:
+                print("Restarting cluster {} (shards {})".format(worker.cluster, worker.shards))
+                await self.restart(worker)
+
+    def stop(self):
+        self.running = False
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Typheus as a cluster of worker processes")
+    parser.add_argument("--clusters", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shard-count", type=int, help="Defaults to Discord's recommendation")
+    parser.add_argument("--ipc-port", type=int, default=IPC_PORT)
+    args, rest = parser.parse_known_args()
+
+    loop = asyncio.get_event_loop()
+    shard_count = args.shard_count
+    if shard_count is None:
+        with open("resources/auth", 'rb') as ath:
+            token = json.loads(ath.read().decode("utf-8", "replace"))[0][0]
+        shard_count = loop.run_until_complete(recommended_shards(token))
+
+    launcher = Launcher(min(args.clusters, shard_count), shard_count, args=rest, loop=loop, ipc_port=args.ipc_port)
+    pool = loop.run_until_complete(asyncpg.create_pool(**CONNECTION))
+    runner = ClusterRunner(launcher, pool)
+
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(launcher.rolling_restart()))
+    asyncio.ensure_future(runner.app.start('0.0.0.0', 5000))
+    asyncio.ensure_future(launcher.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        launcher.stop()
+
+
+if __name__ == "__main__":
+    main()
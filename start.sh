@@ -1,14 +1,3 @@
-running=1
-
-finish()
-{
-    running=0
-}
-
-trap finish SIGINT
-
-while (( running )); do
-    python3 Typheus.py
-    echo "Restarting server on crash.."
-    sleep 5
-done
\ No newline at end of file
+#!/usr/bin/env bash
+# The launcher supervises and restarts the workers itself, see launcher.py --help
+exec python3 launcher.py "$@"